@@ -4,17 +4,24 @@
 # ------------------------------------------------------------
 import streamlit as st
 from db import init_db
-from ocr import ocr_many
+from jobs import init_jobs
+from spool import sweep
 from ui import (
     init_session_state, 
     render_upload_tabs, 
+    start_ocr,
+    render_ocr_progress,
     render_edit_form, 
     render_duplicate_resolution, 
-    render_contact_database
+    render_contact_database,
+    render_stats_panel
 )
 
 # データベース初期化
 init_db()
+init_jobs()
+# 放置されたセッションの撮影画像の一時ファイルを削除 (起動時と、その後は1時間ごと)
+sweep()
 
 # Streamlit UI 設定
 st.set_page_config(page_title="名刺 OCR Demo", page_icon="📇")
@@ -44,19 +51,16 @@ if has_camera_images:
 
 # 解析開始ボタン
 if st.button("🔊 解析開始", disabled=(not has_files and not has_camera_images)) and all_files:
-    st.info(f"📝 合計 {len(all_files)} 枚の画像を処理中...")
-    
-    # ファイルをOCR処理
-    cards = ocr_many(all_files)
-    
-    # OCR結果をセッションに保存し、編集モードを有効化
-    st.session_state.ocr_results = cards
-    st.session_state.edit_mode = True
-    st.session_state.edited_cards = cards.copy()
+    # OCRジョブを登録し、編集モードを有効化
+    # (ワーカーが解析し終わったカードから順に編集フォームへ表示される)
+    start_ocr(all_files)
     
     # ページを再読み込みして編集フォームを表示
     st.rerun()
 
+# OCRの進捗表示
+render_ocr_progress()
+
 # 編集フォーム表示
 render_edit_form()
 
@@ -64,4 +68,7 @@ render_edit_form()
 render_duplicate_resolution()
 
 # データベース一覧表示
-render_contact_database()
\ No newline at end of file
+render_contact_database()
+
+# 処理統計表示
+render_stats_panel()
\ No newline at end of file
@@ -0,0 +1,188 @@
+# backends.py
+# OCRバックエンドの共通インターフェースと、安価なバックエンドから順に試すチェーン
+#   OCR_BACKENDS=tesseract,openai  → ローカルOCRで主要フィールドが揃わなかった名刺だけをVisionモデルに送る
+# バックエンドごとの処理枚数・解決枚数は metrics の "ocr.backend.<名前>" に記録される
+import io
+import os
+import re
+import abc
+import hashlib
+import logging
+from typing import Dict, List, Sequence, Tuple
+from models import Card
+import metrics
+
+try:
+    import pytesseract
+    from PIL import Image, ImageOps
+except ImportError:  # pytesseract (とTesseract本体) が無い環境ではローカルOCRを使わない
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+# ローカルOCRの単語の信頼度 (0〜100) の下限。これ未満の行からは値を取り出さない
+OCR_LOCAL_MIN_CONF = float(os.environ.get("OCR_LOCAL_MIN_CONF", "80"))
+OCR_TESSERACT_LANG = os.environ.get("OCR_TESSERACT_LANG", "jpn+eng")
+
+
+class Backend(abc.ABC):
+    # name: 集計・キャッシュキーに使う名前 (設定が変わると結果も変わる場合は設定値も含める)
+    name = "backend"
+
+    @abc.abstractmethod
+    def recognize(self, files: Sequence) -> List[Card]:
+        # 画像と同じ順で、確信を持って読み取れたフィールドだけを持つカードを返す
+        # 読み取りに失敗した画像は {"error": ...} を含むカードにする
+        ...
+
+
+def _merge(card: Card, result: Card) -> Card:
+    # 後段のバックエンドの値を優先し、後段が読めなかった (None の) フィールドは前段の値を残す
+    merged = {k: v for k, v in card.items() if k != "error"}
+    merged.update({k: v for k, v in result.items() if v is not None or k not in merged})
+    return merged
+
+
+def run_chain(files: Sequence, backends: Sequence[Backend], key_fields: Sequence[str],
+              fields: Sequence[str]) -> List[Card]:
+    # key_fields がすべて揃ったカードはそこで確定し、揃わなかったカードだけを次のバックエンドに渡す
+    cards: List[Card] = [{} for _ in files]
+    todo = list(range(len(files)))
+    for backend in backends:
+        if not todo:
+            break
+        results = backend.recognize([files[i] for i in todo])
+        remaining = []
+        for i, result in zip(todo, results):
+            cards[i] = _merge(cards[i], result)
+            if "error" in cards[i] or any(cards[i].get(f) is None for f in key_fields):
+                remaining.append(i)
+        metrics.record(f"ocr.backend.{backend.name}", cards=len(todo), resolved=len(todo) - len(remaining))
+        todo = remaining
+    for card in cards:
+        for field in fields:
+            card.setdefault(field, None)
+    return cards
+
+
+def chain_name(backends: Sequence[Backend]) -> str:
+    return ">".join(b.name for b in backends)
+
+
+class StubBackend(Backend):
+    # テスト・ベンチマーク用の決定的なバックエンド (APIもOCRエンジンも使わない)
+    # cards: 画像バイト列の sha256 → 返すカード。登録されていない画像は読み取れなかった扱い
+    # 指定しなければ、画像のハッシュから氏名・メールアドレスを作る
+    name = "stub"
+
+    def __init__(self, cards: Dict[str, Card] | None = None):
+        self.cards = cards
+
+    def recognize(self, files: Sequence) -> List[Card]:
+        out = []
+        for f in files:
+            digest = hashlib.sha256(f.getvalue()).hexdigest()
+            if self.cards is None:
+                out.append({"name": f"stub {digest[:8]}", "email": f"stub-{digest[:8]}@example.com"})
+            else:
+                out.append(dict(self.cards.get(digest, {})))
+        return out
+
+
+# ---- ローカルOCR (Tesseract) + 正規表現による抽出 ----
+
+EMAIL_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}")
+URL_RE = re.compile(r"(?:https?://|www\.)[A-Za-z0-9./_%#?=&-]+", re.IGNORECASE)
+PHONE_RE = re.compile(r"\+?\d[\d\-‐ー−() ]{7,}\d")
+FAX_LABEL_RE = re.compile(r"fax|ファックス|ファクス", re.IGNORECASE)
+MOBILE_LABEL_RE = re.compile(r"携帯|mobile|cell|\bm[.:]", re.IGNORECASE)
+COMPANY_RE = re.compile(r"株式会社|有限会社|合同会社|\(株\)|（株）|inc\.?$|co\.,? ?ltd|corporation|\bllc\b", re.IGNORECASE)
+ADDRESS_RE = re.compile(r"^〒|\d{3}-\d{4}.*(都|道|府|県)|(都|道|府|県).+\d")
+
+
+def _clean(text: str) -> str:
+    # Tesseractは日本語を1文字ずつの単語に分けるので、日本語の文字の間の空白を詰める
+    return re.sub(r"(?<=[^\x00-\x7f]) (?=[^\x00-\x7f])", "", text.strip())
+
+
+def extract_fields(lines: Sequence[Tuple[str, float, float]], min_conf: float | None = None) -> Card:
+    # lines: (行のテキスト, 平均信頼度, 文字の高さ) のリスト
+    # 書式で判別できる値 (メール・URL・電話/FAX・会社名・住所) と、最も大きな文字の行を氏名として取り出す
+    min_conf = OCR_LOCAL_MIN_CONF if min_conf is None else min_conf
+    card: Card = {}
+    candidates = []
+    for text, conf, height in lines:
+        text = text.strip()
+        if not text or conf < min_conf:
+            continue
+        compact = text.replace(" ", "")
+        email = EMAIL_RE.search(compact)
+        url = URL_RE.search(compact)
+        phone = PHONE_RE.search(text)
+        if email:
+            card.setdefault("email", email.group(0).lower())
+        elif url:
+            card.setdefault("company_url", url.group(0))
+        elif phone:
+            # "TEL 03-1234-5678 FAX 03-1234-5679" のように1行に複数の番号がある場合は、番号ごとに直前のラベルで判別する
+            start = 0
+            for match in PHONE_RE.finditer(text):
+                label = text[start:match.start()].replace(" ", "")
+                start = match.end()
+                number = re.sub(r"[‐ー−]", "-", match.group(0)).replace(" ", "")
+                if FAX_LABEL_RE.search(label):
+                    card.setdefault("company_fax", number)
+                elif MOBILE_LABEL_RE.search(label):
+                    card.setdefault("phone", number)
+                else:
+                    card.setdefault("company_phone", number)
+        elif COMPANY_RE.search(compact):
+            card.setdefault("company", _clean(text))
+        elif ADDRESS_RE.search(compact):
+            card.setdefault("company_address", _clean(text))
+        elif len(compact) <= 20 and not re.search(r"\d", compact):
+            candidates.append((height, _clean(text)))
+    # 名刺の氏名は他の行より明らかに大きな文字で書かれていることが多い。差が小さい場合は判断しない
+    candidates.sort(reverse=True)
+    if candidates and (len(candidates) == 1 or candidates[0][0] >= 1.3 * candidates[1][0]):
+        card["name"] = candidates[0][1]
+    return card
+
+
+class TesseractBackend(Backend):
+    name = "tesseract"
+
+    def __init__(self, lang: str | None = None, min_conf: float | None = None):
+        if pytesseract is None:
+            raise RuntimeError("tesseract backend requires pytesseract and the Tesseract binary")
+        self.lang = lang or OCR_TESSERACT_LANG
+        self.min_conf = OCR_LOCAL_MIN_CONF if min_conf is None else min_conf
+        self.name = f"tesseract:{self.lang}:{self.min_conf:g}"
+
+    def _lines(self, data: bytes) -> List[Tuple[str, float, float]]:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        words = pytesseract.image_to_data(img, lang=self.lang, output_type=pytesseract.Output.DICT)
+        grouped: Dict[tuple, list] = {}
+        for i, text in enumerate(words["text"]):
+            conf = float(words["conf"][i])
+            if not text.strip() or conf < 0:
+                continue
+            key = (words["block_num"][i], words["par_num"][i], words["line_num"][i])
+            grouped.setdefault(key, []).append((text, conf, words["height"][i]))
+        lines = []
+        for items in grouped.values():
+            # 日本語は1文字ずつ単語に分かれるので、行内の単語は空白でつないだまま正規表現側で吸収する
+            lines.append((" ".join(t for t, _, _ in items),
+                          sum(c for _, c, _ in items) / len(items),
+                          max(h for _, _, h in items)))
+        return lines
+
+    def recognize(self, files: Sequence) -> List[Card]:
+        out = []
+        for f in files:
+            try:
+                out.append(extract_fields(self._lines(f.getvalue()), self.min_conf))
+            except Exception as e:
+                logger.warning("ローカルOCRエラー: %s", e)
+                out.append({})
+        return out
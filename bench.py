@@ -0,0 +1,886 @@
+# bench.py
+# ------------------------------------------------------------
+# ローカルのフェイククライアントを使った性能計測 (APIキー不要)
+#   python bench.py ocr --cards 50 --latency 0.2 --workers 8
+#   python bench.py suite --sizes 1000 100000 1000000 --output bench.json
+# ------------------------------------------------------------
+import os
+import io
+import json
+import logging
+import random
+import base64
+import hashlib
+import time
+import sqlite3
+import argparse
+import contextlib
+import tempfile
+import threading
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import ocr
+import jobs
+import cache
+import metrics
+import ratelimit
+import spool
+import transfer
+import backends
+import preprocess
+import db
+import graph
+
+
+class FakeUpload:
+    # st.file_uploader の UploadedFile と同じインターフェース (name / getvalue)
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self._data = data
+
+    def getvalue(self) -> bytes:
+        return self._data
+
+
+class FakeAPIError(Exception):
+    # openai.APIStatusError と同じく status_code と response.headers を持つ
+    def __init__(self, status_code: int, headers: dict | None = None):
+        super().__init__(f"fake API error {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class FakeClient:
+    # OpenAI互換の chat.completions.create だけを持つスタブ
+    # 複数画像のリクエストにはJSON配列で応答する (batch_mismatch=True なら1件少なく返す)
+    # shapes: 応答形式ごとの重み ("json" / "fenced": ```json で囲む / "malformed": 壊れたJSON)
+    # error_rate: 503を返す割合。quota_rps: 直近1秒のリクエスト数がこれを超えると429を返す
+    def __init__(self, latency: float = 0.05, fail_on=(), batch_mismatch: bool = False, jitter: float = 0.0,
+                 error_rate: float = 0.0, shapes: dict | None = None, seed: int = 0, quota_rps: float | None = None):
+        self.latency = latency
+        self.fail_on = set(fail_on)
+        self.batch_mismatch = batch_mismatch
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.shapes = shapes or {"json": 1.0}
+        self.quota_rps = quota_rps
+        self.calls = 0
+        self.rejected = 0
+        self._window = deque()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=self.create, with_raw_response=SimpleNamespace(create=self._create_raw)))
+
+    def _headers(self) -> dict:
+        return {"x-ratelimit-limit-requests": str(int(self.quota_rps * 60))} if self.quota_rps else {}
+
+    def _admit(self):
+        # 直近1秒のリクエスト数で上限を判定する
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1.0:
+            self._window.popleft()
+        if len(self._window) >= self.quota_rps:
+            self.rejected += 1
+            retry_ms = int((1.0 - (now - self._window[0])) * 1000) + 1
+            raise FakeAPIError(429, {**self._headers(), "retry-after-ms": str(retry_ms)})
+        self._window.append(now)
+
+    def _create_raw(self, **kwargs):
+        resp = self.create(**kwargs)
+        return SimpleNamespace(parse=lambda: resp, headers=self._headers())
+
+    def create(self, model, messages, **kwargs):
+        with self._lock:
+            self.calls += 1
+            if self.quota_rps:
+                self._admit()
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            failed = self._rng.random() < self.error_rate
+            shape = self._rng.choices(list(self.shapes), weights=list(self.shapes.values()))[0]
+        time.sleep(delay)
+        if failed:
+            raise FakeAPIError(503)
+        # data URI の末尾 (画像バイト列) からカード番号を復元して応答に埋め込む
+        cards = []
+        for part in messages[-1]["content"]:
+            url = part["image_url"]["url"]
+            idx = int(base64.b64decode(url.split(",", 1)[1]).decode())
+            if idx in self.fail_on:
+                raise RuntimeError(f"fake failure for card {idx}")
+            card = {field: None for field in ocr.REQUIRED_FIELDS}
+            card.update(name=f"名刺 {idx}", email=f"user{idx}@example.com")
+            cards.append(card)
+        if len(cards) == 1:
+            body = cards[0]
+        else:
+            body = cards[:-1] if self.batch_mismatch else cards
+        content = json.dumps(body, ensure_ascii=False)
+        if shape == "fenced":
+            content = f"```json\n{content}\n```"
+        elif shape == "malformed":
+            content = content[:len(content) // 2]
+        message = SimpleNamespace(content=content)
+        # トークン数は画像の枚数と解析精度からの概算 (low: 85, high: 765 トークン/枚)
+        per_image = 85 if messages[-1]["content"][0]["image_url"]["detail"] == "low" else 765
+        prompt_tokens, completion_tokens = per_image * len(cards) + 400, len(content) // 2
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def make_contacts_db(path: str, rows: int, reuse: bool = False):
+    # 合成データの contacts テーブルを作成する (reuse=True なら同じ件数の既存ファイルを使い回す)
+    db.DB_PATH = path
+    if reuse and os.path.exists(path):
+        with sqlite3.connect(path) as con:
+            if con.execute("SELECT COUNT(*) FROM contacts WHERE email LIKE 'user%'").fetchone()[0] == rows:
+                db.init_db()
+                return
+        os.remove(path)
+    db.init_db()
+
+    def generate():
+        for i in range(rows):
+            card = {"name": f"名前 {i}", "company": f"会社 {i % 1000}", "email": f"user{i}@example.com",
+                    "phone": f"090-{i:08d}", "department": "営業部", "job_title": "課長", "qualification": None,
+                    "company_address": f"東京都千代田区 {i}", "company_url": f"https://company{i % 1000}.example.com",
+                    "company_phone": f"03-{i:08d}", "company_fax": None}
+            yield tuple(card[f] for f in db.CARD_FIELDS) + db.blocking_keys(card)
+
+    with sqlite3.connect(path) as con:
+        con.executemany(
+            """INSERT INTO contacts
+               (name, company, email, phone, department, job_title, qualification,
+                company_address, company_url, company_phone, company_fax,
+                phone_key, name_key, domain_key)
+               VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            generate(),
+        )
+
+
+def percentile(values, p: float) -> float:
+    # 最近接順位法によるパーセンタイル
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, min(len(ordered), int(round(p / 100 * len(ordered) + 0.5))))
+    return ordered[rank - 1]
+
+
+def summarize(stage: str, durations, items_per_call: int, **extra):
+    # 1回の呼び出しごとの所要時間 (秒) から、スループットと p50/p99 をまとめる
+    total = sum(durations)
+    result = {
+        "stage": stage,
+        **extra,
+        "calls": len(durations),
+        "items_per_call": items_per_call,
+        "p50_ms": round(percentile(durations, 50) * 1000, 3),
+        "p99_ms": round(percentile(durations, 99) * 1000, 3),
+        "mean_ms": round(total / len(durations) * 1000, 3) if durations else 0.0,
+        "throughput_per_sec": round(items_per_call * len(durations) / total, 1) if total else 0.0,
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def make_uploads(n: int):
+    return [FakeUpload(f"card{i}.jpg", str(i).encode()) for i in range(n)]
+
+
+def bench_ocr(cards: int, latency: float, workers: int):
+    files = make_uploads(cards)
+
+    t0 = time.perf_counter()
+    seq = ocr.ocr_many(files, max_workers=1, client=FakeClient(latency), use_cache=False)
+    t_seq = time.perf_counter() - t0
+
+    fail_on = {cards // 2}
+    t0 = time.perf_counter()
+    par = ocr.ocr_many(files, max_workers=workers, client=FakeClient(latency, fail_on), use_cache=False)
+    t_par = time.perf_counter() - t0
+
+    # 入力順の保持と、1枚の失敗がバッチを止めないことを確認
+    assert [c["email"] for c in seq] == [f"user{i}@example.com" for i in range(cards)]
+    for i, c in enumerate(par):
+        if i in fail_on:
+            assert c["error"] == "request_failed"
+        else:
+            assert c["email"] == f"user{i}@example.com"
+
+    result = {
+        "stage": "ocr_many",
+        "cards": cards,
+        "latency": latency,
+        "workers": workers,
+        "sequential_sec": round(t_seq, 3),
+        "concurrent_sec": round(t_par, 3),
+        "speedup": round(t_seq / t_par, 2),
+        "ideal_speedup": min(workers, cards),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_batch(cards: int, latency: float, workers: int, batch_size: int):
+    files = make_uploads(cards)
+    expected = [f"user{i}@example.com" for i in range(cards)]
+    result = {"stage": "ocr_batch", "cards": cards, "latency": latency, "workers": workers, "batch_size": batch_size}
+
+    for label, size, mismatch in (("single", 1, False), ("batched", batch_size, False), ("fallback", batch_size, True)):
+        fake = FakeClient(latency, batch_mismatch=mismatch)
+        t0 = time.perf_counter()
+        out = ocr.ocr_many(files, max_workers=workers, client=fake, use_cache=False, batch_size=size)
+        elapsed = time.perf_counter() - t0
+        # 件数が合わない応答は1枚ずつの処理に切り替わり、結果は常に入力順
+        assert [c["email"] for c in out] == expected
+        result[f"{label}_requests"] = fake.calls
+        result[f"{label}_sec"] = round(elapsed, 3)
+
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_ratelimit(cards: int, latency: float, workers: int, quota_rps: float):
+    # 上限 quota_rps のAPIに対して、スケジューラー無し (429はそのまま失敗) と有りを比較する
+    files = make_uploads(cards)
+    result = {"stage": "ratelimit", "cards": cards, "latency": latency, "workers": workers, "quota_rps": quota_rps}
+    schedulers = {
+        # 従来の動作: 待たず、再試行もしない
+        "unscheduled": SimpleNamespace(call=lambda fn, tokens: fn()[0]),
+        # RPMは初期値から始め、応答ヘッダーの上限に追従する
+        "scheduled": ratelimit.Scheduler(tpm=10 ** 10, retry_base=latency),
+    }
+    saved = ocr.scheduler
+    try:
+        for label, scheduler in schedulers.items():
+            ocr.scheduler = scheduler
+            fake = FakeClient(latency, quota_rps=quota_rps)
+            t0 = time.perf_counter()
+            out = ocr.ocr_many(files, max_workers=workers, client=fake, use_cache=False)
+            elapsed = time.perf_counter() - t0
+            ok = sum(1 for c in out if "error" not in c)
+            result[f"{label}_ok"] = ok
+            result[f"{label}_429"] = fake.rejected
+            result[f"{label}_sec"] = round(elapsed, 3)
+            result[f"{label}_ok_per_sec"] = round(ok / elapsed, 1)
+    finally:
+        ocr.scheduler = saved
+    assert result["scheduled_ok"] == cards
+    # 上限に対してどれだけ使い切れたか
+    result["scheduled_quota_use"] = round(result["scheduled_ok_per_sec"] / quota_rps, 2)
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_backends(cards: int, latency: float, workers: int, local_rate: float):
+    # ローカルOCRで主要フィールドが揃う割合を local_rate とし、Visionモデルだけの場合とAPI呼び出し数を比較する
+    # ローカルOCRの代わりに、読めた名刺だけ結果を返すスタブを使う
+    files = make_uploads(cards)
+    expected = [f"user{i}@example.com" for i in range(cards)]
+    local = {}
+    for i, f in enumerate(files):
+        digest = hashlib.sha256(f.getvalue()).hexdigest()
+        if i < cards * local_rate:
+            local[digest] = {"name": f"user{i}", "email": f"user{i}@example.com", "company_phone": "03-0000-0000"}
+        elif i % 2:
+            # 一部だけ読めた名刺はVisionモデルに回り、読めた値はVisionモデルの結果で上書きされる
+            local[digest] = {"email": f"wrong{i}@example.com"}
+    result = {"stage": "backends", "cards": cards, "latency": latency, "workers": workers, "local_rate": local_rate}
+
+    for label, make_chain in (("openai", lambda c: [ocr.OpenAIBackend(c)]),
+                              ("chained", lambda c: [backends.StubBackend(local), ocr.OpenAIBackend(c)])):
+        fake = FakeClient(latency)
+        metrics.reset()
+        t0 = time.perf_counter()
+        out = ocr.ocr_many(files, max_workers=workers, use_cache=False, backends=make_chain(fake))
+        elapsed = time.perf_counter() - t0
+        assert [c["email"] for c in out] == expected
+        result[f"{label}_requests"] = fake.calls
+        result[f"{label}_sec"] = round(elapsed, 3)
+        result[f"{label}_backends"] = {name[len("ocr.backend."):]: {"cards": stat["cards_total"],
+                                                                     "resolved": stat["resolved_total"]}
+                                       for name, stat in metrics.snapshot().items()
+                                       if name.startswith("ocr.backend.")}
+    result["requests_saved"] = result["openai_requests"] - result["chained_requests"]
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_jobs(big: int, small: int, latency: float, workers: int, claim_size: int):
+    # 大きなジョブの直後に小さなジョブを登録し、それぞれが終わるまでの時間を計測する
+    # 小さなジョブは大きなジョブの完了を待たずに終わること、キュー経由でもスループットが落ちないことを確認する
+    files = make_uploads(big)
+    t0 = time.perf_counter()
+    ocr.ocr_many(files, max_workers=workers, client=FakeClient(latency), use_cache=False)
+    direct = time.perf_counter() - t0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = f"{tmp}/jobs.db"
+        cache.CACHE_PATH = f"{tmp}/ocr_cache.db"
+        jobs.init_jobs(path)
+        big_id = jobs.enqueue(files, path)
+        small_id = jobs.enqueue([FakeUpload(f"small{i}.jpg", str(big + i).encode()) for i in range(small)], path)
+        stop = threading.Event()
+        worker = threading.Thread(target=jobs.work, kwargs=dict(
+            max_workers=workers, claim_size=claim_size, poll_interval=0.01, client=FakeClient(latency),
+            stop=stop, path=path))
+        t0 = time.perf_counter()
+        worker.start()
+        finished = {}
+        while len(finished) < 2:
+            for name, job_id in (("small", small_id), ("big", big_id)):
+                status = jobs.job_status(job_id, path)
+                if name not in finished and status["done"] + status["failed"] == status["total"]:
+                    finished[name] = time.perf_counter() - t0
+            time.sleep(0.01)
+        stop.set()
+        worker.join()
+        assert [c["email"] for c in jobs.job_results(small_id, path)] == \
+            [f"user{big + i}@example.com" for i in range(small)]
+
+    result = {
+        "stage": "jobs",
+        "big": big,
+        "small": small,
+        "latency": latency,
+        "workers": workers,
+        "direct_big_sec": round(direct, 3),
+        "queued_big_sec": round(finished["big"], 3),
+        "queued_small_sec": round(finished["small"], 3),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_check_dup(cards: int, rows: int):
+    # 半分は既存の連絡先 (大文字・空白の表記ゆれ付き)、半分は新規
+    batch = [{"name": f"名前 {i}", "email": f"  USER{i * 2}@Example.com " if i % 2 == 0 else f"new{i}@example.com"}
+             for i in range(cards)]
+    with tempfile.TemporaryDirectory() as tmp:
+        make_contacts_db(f"{tmp}/contacts.db", rows)
+
+        # 従来方式: カードごとに接続してSELECT
+        t0 = time.perf_counter()
+        legacy_dups = sum(1 for c in batch if db.exists(c["email"]))
+        t_legacy = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        state = graph.check_dup({"cards": batch})
+        t_set = time.perf_counter() - t0
+
+        # 同じ名刺を2回撮影した (メールアドレス無し) カードと、誤読したメールアドレスを直したカードが
+        # 同じ既存連絡先にあいまい一致しても、決定のキーは別々になり、上書きはその連絡先の行を更新する
+        same = {"name": "名前 0", "company": "会社 0", "phone": "090-00000000"}
+        fuzzy = graph.check_dup({"cards": [dict(same), dict(same), dict(same, email="fixed0@example.com")]})
+        keys = [graph.dup_key(c) for c in fuzzy["dup_cards"]]
+        assert len(keys) == 3 == len(set(keys)), keys
+        assert {c["duplicate_of"]["id"] for c in fuzzy["dup_cards"]} == {1}
+        fuzzy["decisions"] = {keys[0]: "skip", keys[1]: "overwrite", keys[2]: "overwrite"}
+        fuzzy = graph.save_node(graph.apply_decision(fuzzy))
+        assert fuzzy["skipped"] == [keys[0]] and fuzzy["saved"] == {"inserted": 0, "updated": 1}, fuzzy["saved"]
+        with sqlite3.connect(db.DB_PATH) as con:
+            assert con.execute("SELECT COUNT(*) FROM contacts").fetchone()[0] == rows
+            assert con.execute("SELECT email FROM contacts WHERE id=1").fetchone()[0] == "fixed0@example.com"
+
+    assert len(state["dup_cards"]) == legacy_dups == (cards + 1) // 2
+    result = {
+        "stage": "check_dup",
+        "cards": cards,
+        "rows": rows,
+        "per_card_sec": round(t_legacy, 4),
+        "set_based_sec": round(t_set, 4),
+        "speedup": round(t_legacy / t_set, 1),
+        "duplicates": len(state["dup_cards"]),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_save(rows: int):
+    cards = [{"name": f"名前 {i}", "company": f"会社 {i % 1000}", "email": f"user{i}@example.com",
+              "phone": f"090-{i:08d}"} for i in range(rows)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = f"{tmp}/contacts.db"
+        db.init_db()
+
+        t0 = time.perf_counter()
+        first = db.save_cards(cards)
+        t_insert = time.perf_counter() - t0
+
+        # 半分を既存の更新、半分を新規にして再度保存
+        half = rows // 2
+        mixed = cards[half:] + [dict(c, email=f"new{i}@example.com") for i, c in enumerate(cards[:half])]
+        t0 = time.perf_counter()
+        second = db.save_cards(mixed)
+        t_mixed = time.perf_counter() - t0
+
+    assert first == {"inserted": rows, "updated": 0}
+    assert second == {"inserted": half, "updated": rows - half}
+    result = {
+        "stage": "save_cards",
+        "rows": rows,
+        "insert_sec": round(t_insert, 3),
+        "insert_rows_per_sec": round(rows / t_insert),
+        "mixed_upsert_sec": round(t_mixed, 3),
+        "mixed_rows_per_sec": round(rows / t_mixed),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def _peak_mb(fn):
+    # fn の実行中にPythonが確保したメモリのピーク (MB)。計測中は遅くなるので所要時間は別に測る
+    tracemalloc.start()
+    try:
+        value = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return value, round(peak / 2 ** 20, 2)
+
+
+def bench_memory(cards: int, image_kb: int, limit_mb: float, latency: float, workers: int):
+    # 全画像をメモリに持ったまま解析する場合と、一時ファイルに書き出してメモリの上限内で解析する場合の、メモリのピークを比較する
+    # 画像はカード番号の後ろを空白で埋めたバイト列 (フェイクAPIは番号だけを読む)
+    size = image_kb * 1024
+    result = {"stage": "memory", "cards": cards, "image_kb": image_kb, "limit_mb": limit_mb, "workers": workers}
+    expected = [f"user{i}@example.com" for i in range(cards)]
+    saved = ocr.OCR_MEMORY_LIMIT_MB
+    with tempfile.TemporaryDirectory() as tmp:
+        def in_memory():
+            files = [FakeUpload(f"card{i}.jpg", str(i).encode().ljust(size)) for i in range(cards)]
+            return ocr.ocr_many(files, max_workers=workers, client=FakeClient(latency), use_cache=False)
+
+        def spooled():
+            files = [spool.spill(FakeUpload(f"card{i}.jpg", str(i).encode().ljust(size)), tmp) for i in range(cards)]
+            return ocr.ocr_many(files, max_workers=workers, client=FakeClient(latency), use_cache=False)
+
+        try:
+            for label, fn, limit in (("in_memory", in_memory, float("inf")), ("spooled", spooled, limit_mb)):
+                ocr.OCR_MEMORY_LIMIT_MB = limit
+                metrics.reset()
+                t0 = time.perf_counter()
+                out, peak = _peak_mb(fn)
+                result[f"{label}_sec"] = round(time.perf_counter() - t0, 3)
+                assert [c["email"] for c in out] == expected
+                result[f"{label}_peak_mb"] = peak
+                result[f"{label}_memory_waits"] = metrics.snapshot().get("ocr.memory_wait", {}).get("count", 0)
+
+            # ワーカーの各スレッドのように複数の呼び出しが同時に解析しても、上限はプロセス全体で守られる
+            ocr.OCR_MEMORY_LIMIT_MB = limit_mb
+            ocr.memory_budget.peak = 0
+            with ThreadPoolExecutor(max_workers=4) as callers:
+                for out in callers.map(lambda _: spooled(), range(4)):
+                    assert [c["email"] for c in out] == expected
+            need = size * ocr.IMAGE_MEMORY_FACTOR
+            assert ocr.memory_budget.in_use == 0
+            assert ocr.memory_budget.peak <= max(limit_mb * 2 ** 20, need), ocr.memory_budget.peak
+            result["concurrent_budget_peak_mb"] = round(ocr.memory_budget.peak / 2 ** 20, 2)
+        finally:
+            ocr.OCR_MEMORY_LIMIT_MB = saved
+    result["images_total_mb"] = round(cards * size / 2 ** 20, 1)
+    result["peak_rss_mb"] = round(metrics.peak_rss_mb() or 0, 1)
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_transfer(rows: int, chunk_size: int):
+    # 各形式でエクスポート→別DBへインポートし、件数が変わらないことと、メモリのピークが件数に比例しないことを確認する
+    result = {"stage": "transfer", "rows": rows, "chunk_size": chunk_size}
+    with tempfile.TemporaryDirectory() as tmp:
+        source = f"{tmp}/source.db"
+        make_contacts_db(source, rows)
+        sample = dict(zip(db.CARD_FIELDS, db.get_all_contacts()[rows // 2]))
+        # 比較用: 従来の get_all_contacts は全件をメモリに載せる
+        result["fetchall_peak_mb"] = _peak_mb(db.get_all_contacts)[1]
+        for fmt, ext in (("csv", "csv"), ("vcard", "vcf"), ("jsonl", "jsonl")):
+            path = f"{tmp}/contacts.{ext}"
+            db.DB_PATH = source
+            t0 = time.perf_counter()
+            assert transfer.export_contacts(path, chunk_size=chunk_size)["rows"] == rows
+            result[f"{fmt}_export_rows_per_sec"] = round(rows / (time.perf_counter() - t0))
+            result[f"{fmt}_export_peak_mb"] = _peak_mb(lambda: transfer.export_contacts(path, chunk_size=chunk_size))[1]
+            result[f"{fmt}_file_mb"] = round(os.path.getsize(path) / 2 ** 20, 1)
+
+            db.DB_PATH = f"{tmp}/import_{fmt}.db"
+            t0 = time.perf_counter()
+            summary = transfer.import_contacts(path, chunk_size=chunk_size)
+            result[f"{fmt}_import_rows_per_sec"] = round(rows / (time.perf_counter() - t0))
+            assert summary == {"rows": rows, "inserted": rows, "updated": 0, "skipped": 0}, summary
+            # 同じファイルを再度インポートすると全件が更新になる (save_cards と同じupsert)
+            summary, result[f"{fmt}_import_peak_mb"] = _peak_mb(
+                lambda: transfer.import_contacts(path, chunk_size=chunk_size))
+            assert summary["updated"] == rows, summary
+            with db.connect() as con:
+                row = con.execute(f"SELECT {', '.join(db.CARD_FIELDS)} FROM contacts WHERE email = ?",
+                                  (sample["email"],)).fetchone()
+            assert dict(zip(db.CARD_FIELDS, row)) == sample, (fmt, row)
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def _save_direct(cards):
+    # 比較用: 書き込み専用スレッドを使わず、呼び出しごとに接続を開いて書き込みロックを取り合う従来の保存
+    rows = db._card_rows(cards)
+    con = db.connect()
+    try:
+        with con:
+            con.execute("BEGIN IMMEDIATE")
+            return db._upsert(con, rows)
+    finally:
+        con.close()
+
+
+def bench_sessions(sessions: int, saves: int, cards: int, rows: int):
+    # 複数のセッション (スレッド) が同時に一覧を読みながら保存する負荷試験
+    result = {"stage": "sessions", "sessions": sessions, "saves_per_session": saves, "cards_per_save": cards,
+              "rows": rows}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, save in (("direct", _save_direct), ("writer", db.save_cards)):
+            make_contacts_db(f"{tmp}/{label}.db", rows)
+            metrics.reset()
+            latencies, errors = [], []
+            lock = threading.Lock()
+
+            def session(n):
+                for k in range(saves):
+                    # 半分は既存の連絡先の更新、半分は新規
+                    batch = [{"name": f"名前 {n}-{k}-{i}", "company": f"会社 {n}",
+                              "email": f"user{(n * saves + k) * cards + i}@example.com" if i % 2 else
+                                       f"s{n}-{k}-{i}@example.com"} for i in range(cards)]
+                    t0 = time.perf_counter()
+                    try:
+                        save(batch)
+                    except sqlite3.OperationalError as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - t0)
+                    db.invalidate_cache()
+                    db.list_contacts(limit=50)
+                    db.count_contacts()
+
+            threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - t0
+            result[f"{label}_rows_per_sec"] = round(len(latencies) * cards / elapsed)
+            result[f"{label}_save_p50_ms"] = round(percentile(latencies, 50) * 1000, 1)
+            result[f"{label}_save_p99_ms"] = round(percentile(latencies, 99) * 1000, 1)
+            result[f"{label}_errors"] = len(errors)
+            if label == "writer":
+                result["writer_commits"] = metrics.snapshot().get("db.group_commit", {}).get("count", 0)
+            with db.reading() as con:
+                expected = rows + sessions * saves * (cards // 2)
+                assert con.execute("SELECT COUNT(*) FROM contacts").fetchone()[0] == expected - (
+                    len(errors) * (cards // 2)), label
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_cache(cards: int, latency: float):
+    files = make_uploads(cards)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache.CACHE_PATH = f"{tmp}/ocr_cache.db"
+        before = cache.stats()
+
+        fake = FakeClient(latency)
+        t0 = time.perf_counter()
+        cold = ocr.ocr_many(files, client=fake)
+        t_cold = time.perf_counter() - t0
+        cold_calls = fake.calls
+
+        # 同じ画像を再アップロード → APIは呼ばれない
+        fake = FakeClient(latency)
+        t0 = time.perf_counter()
+        warm = ocr.ocr_many(files, client=fake)
+        t_warm = time.perf_counter() - t0
+        assert fake.calls == 0 and warm == cold
+
+    after = cache.stats()
+    result = {
+        "stage": "ocr_cache",
+        "cards": cards,
+        "cold_sec": round(t_cold, 3),
+        "warm_sec": round(t_warm, 3),
+        "cold_api_calls": cold_calls,
+        "warm_api_calls": fake.calls,
+        "hits": after["hits"] - before["hits"],
+        "misses": after["misses"] - before["misses"],
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def _variants(data: bytes) -> dict:
+    # 撮り直し・再スキャンを想定した変形 (再圧縮・縮小・明るさ・わずかな回転)
+    from PIL import Image, ImageEnhance
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    out = {}
+    for label, variant, quality in (
+        ("recompress", img, 60),
+        ("half_size", img.resize((img.width // 2, img.height // 2)), 85),
+        ("brighter", ImageEnhance.Brightness(img).enhance(1.15), 85),
+        ("rotate_1deg", img.rotate(1, fillcolor="white"), 85),
+    ):
+        buf = io.BytesIO()
+        variant.save(buf, format="JPEG", quality=quality)
+        out[label] = buf.getvalue()
+    return out
+
+
+def bench_similar(entries: int, queries: int, paths):
+    # 知覚ハッシュ索引の検索時間と、(画像を指定した場合) 変形した画像・別の画像とのハッシュの差を計測する
+    rng = random.Random(entries)
+    result = {"stage": "similar", "entries": entries}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache.CACHE_PATH = f"{tmp}/ocr_cache.db"
+        cache.CACHE_MAX_ENTRIES = max(cache.CACHE_MAX_ENTRIES, entries)
+        hashes = {f"k{i}": rng.getrandbits(64) for i in range(entries)}
+        cache.put_many({k: {"name": k} for k in hashes})
+        cache.put_hashes(hashes, "bench")
+        # 既存のハッシュから数ビットだけ変えたものを検索する
+        probes = {}
+        for i, (key, value) in enumerate(rng.sample(sorted(hashes.items()), min(queries, entries))):
+            for bit in rng.sample(range(64), 2):
+                value ^= 1 << bit
+            probes[f"q{i}"] = value
+        t0 = time.perf_counter()
+        found = cache.find_similar(probes, 2, "bench")
+        elapsed = time.perf_counter() - t0
+    result["lookup_ms"] = round(elapsed / len(probes) * 1000, 3)
+    result["found"] = f"{len(found)}/{len(probes)}"
+
+    if paths:
+        images = {os.path.basename(p): open(p, "rb").read() for p in paths}
+        values = {name: preprocess.dhash(data) for name, data in images.items()}
+        for name, data in images.items():
+            result[name] = {label: preprocess.hamming(values[name], preprocess.dhash(v))
+                            for label, v in _variants(data).items()}
+            others = [preprocess.hamming(values[name], v) for n, v in values.items() if n != name]
+            if others:
+                result[name]["nearest_other"] = min(others)
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def bench_preprocess(paths, max_edge: int):
+    before = preprocess.stats()
+    t0 = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as fp:
+            preprocess.prepare_image(fp.read(), max_edge=max_edge)
+    elapsed = time.perf_counter() - t0
+    after = preprocess.stats()
+    result = {
+        "stage": "preprocess",
+        "images": after["images"] - before["images"],
+        "max_edge": max_edge,
+        "bytes_before": after["bytes_before"] - before["bytes_before"],
+        "bytes_after": after["bytes_after"] - before["bytes_after"],
+        "sec": round(elapsed, 3),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def suite_ocr(cards: int, repeat: int, latency: float, jitter: float, error_rate: float, workers: int):
+    # カードごとの完了までの時間 (バッチ開始から) と、バッチ単位のスループットを計測する
+    shapes = {"json": 0.8, "fenced": 0.15, "malformed": 0.05}
+    card_latency, batch_durations, failures = [], [], {"parse_failed": 0, "request_failed": 0}
+    metrics.reset()
+    for r in range(repeat):
+        fake = FakeClient(latency, jitter=jitter, error_rate=error_rate, shapes=shapes, seed=r)
+        started = time.perf_counter()
+        for _, card in ocr.iter_ocr(make_uploads(cards), max_workers=workers, client=fake, use_cache=False):
+            card_latency.append(time.perf_counter() - started)
+            if card.get("error") in failures:
+                failures[card["error"]] += 1
+        batch_durations.append(time.perf_counter() - started)
+    return summarize("ocr_many", batch_durations, cards, latency=latency, error_rate=error_rate, workers=workers,
+                     card_p50_ms=round(percentile(card_latency, 50) * 1000, 3),
+                     card_p99_ms=round(percentile(card_latency, 99) * 1000, 3), **failures,
+                     stages=metrics.snapshot())
+
+
+def _timed(fn, repeat: int):
+    durations = []
+    for _ in range(repeat):
+        # 一覧系のクエリキャッシュに当たらないよう毎回破棄する
+        db.invalidate_cache()
+        t0 = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+
+def suite_db(rows: int, cards: int, repeat: int, data_dir: str):
+    make_contacts_db(os.path.join(data_dir, f"contacts_{rows}.db"), rows, reuse=True)
+    rng = random.Random(rows)
+    results = []
+
+    def dup_batch():
+        # 半分は既存の連絡先、半分は新規 (あいまい照合にも回る)
+        return [{"name": f"名前 {rng.randrange(rows)}", "email": f"user{rng.randrange(rows)}@example.com"} if i % 2 == 0
+                else {"name": f"新規 {i}", "company": f"会社 {i % 1000}", "email": f"new{i}@example.com",
+                      "phone": f"080-{rng.randrange(10 ** 8):08d}"}
+                for i in range(cards)]
+
+    results.append(summarize("check_dup", _timed(lambda: graph.check_dup({"cards": dup_batch()}), repeat),
+                             cards, rows=rows))
+    save_batch = [{"name": f"ベンチ {i}", "email": f"bench{i}@example.com", "phone": f"070-{i:08d}"}
+                  for i in range(cards)]
+    results.append(summarize("save_cards", _timed(lambda: db.save_cards(save_batch), repeat), cards, rows=rows))
+    # 全件読み込みは件数に比例して重いので回数を抑える
+    results.append(summarize("get_all_contacts", _timed(db.get_all_contacts, min(repeat, 3)), rows, rows=rows))
+    results.append(summarize("list_contacts_page", _timed(
+        lambda: db.list_contacts(rng.randrange(rows), 100, "name"), repeat), 100, rows=rows))
+    results.append(summarize("search_contacts", _timed(
+        lambda: db.search_contacts(f"名前 {rng.randrange(rows)}", 100, 0), repeat), 1, rows=rows))
+    return results
+
+
+def bench_suite(sizes, cards: int, repeat: int, latency: float, jitter: float, error_rate: float, workers: int,
+                data_dir: str | None, output: str | None):
+    results = [suite_ocr(cards, repeat, latency, jitter, error_rate, workers)]
+    with contextlib.ExitStack() as stack:
+        if data_dir is None:
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(data_dir, exist_ok=True)
+        for rows in sizes:
+            results += suite_db(rows, cards, repeat, data_dir)
+    if output:
+        with open(output, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, ensure_ascii=False, indent=2)
+    return results
+
+
+def main():
+    # 計測中に出る解析失敗などの警告で結果の出力を埋めない
+    logging.basicConfig(level=logging.ERROR)
+    # フェイクのAPIにはアカウントの上限が無いので、レート制限を外し再試行の待ちも短くする
+    ocr.scheduler = ratelimit.Scheduler(rpm=10 ** 7, tpm=10 ** 10, retry_base=0.01)
+    parser = argparse.ArgumentParser(description="名刺OCRパイプラインのベンチマーク")
+    sub = parser.add_subparsers(dest="target", required=True)
+
+    p_ocr = sub.add_parser("ocr", help="ocr_many の並列化による高速化を計測")
+    p_ocr.add_argument("--cards", type=int, default=50)
+    p_ocr.add_argument("--latency", type=float, default=0.2)
+    p_ocr.add_argument("--workers", type=int, default=8)
+
+    p_batch = sub.add_parser("batch", help="複数枚まとめたリクエストと1枚ずつのリクエストを比較")
+    p_batch.add_argument("--cards", type=int, default=50)
+    p_batch.add_argument("--latency", type=float, default=0.2)
+    p_batch.add_argument("--workers", type=int, default=8)
+    p_batch.add_argument("--batch-size", type=int, default=5)
+
+    p_rate = sub.add_parser("ratelimit", help="レート制限のあるAPIに対するスケジューラーの効果を計測")
+    p_rate.add_argument("--cards", type=int, default=200)
+    p_rate.add_argument("--latency", type=float, default=0.05)
+    p_rate.add_argument("--workers", type=int, default=16)
+    p_rate.add_argument("--quota-rps", type=float, default=20, help="APIが受け付ける1秒あたりのリクエスト数")
+
+    p_back = sub.add_parser("backends", help="ローカルOCRを先に試すバックエンドのチェーンで減るAPI呼び出しを計測")
+    p_back.add_argument("--cards", type=int, default=100)
+    p_back.add_argument("--latency", type=float, default=0.05)
+    p_back.add_argument("--workers", type=int, default=8)
+    p_back.add_argument("--local-rate", type=float, default=0.6, help="ローカルOCRで主要フィールドが揃う名刺の割合")
+
+    p_jobs = sub.add_parser("jobs", help="OCRジョブキューで小さなジョブが大きなジョブに待たされないことを確認")
+    p_jobs.add_argument("--big", type=int, default=200)
+    p_jobs.add_argument("--small", type=int, default=5)
+    p_jobs.add_argument("--latency", type=float, default=0.05)
+    p_jobs.add_argument("--workers", type=int, default=8)
+    p_jobs.add_argument("--claim-size", type=int, default=1)
+
+    p_dup = sub.add_parser("checkdup", help="check_dup の一括照合を従来の1件ずつの照合と比較")
+    p_dup.add_argument("--cards", type=int, default=1000)
+    p_dup.add_argument("--rows", type=int, default=100_000)
+
+    p_save = sub.add_parser("save", help="save_cards の一括upsertのスループットを計測")
+    p_save.add_argument("--rows", type=int, default=100_000)
+
+    p_mem = sub.add_parser("memory", help="画像を一時ファイルに置きメモリの上限内で解析した場合のメモリのピークを計測")
+    p_mem.add_argument("--cards", type=int, default=200)
+    p_mem.add_argument("--image-kb", type=int, default=1024)
+    p_mem.add_argument("--limit-mb", type=float, default=32)
+    p_mem.add_argument("--latency", type=float, default=0.05)
+    p_mem.add_argument("--workers", type=int, default=8)
+
+    p_transfer = sub.add_parser("transfer", help="連絡先のエクスポート・インポートの速度とメモリのピークを計測")
+    p_transfer.add_argument("--rows", type=int, default=100_000)
+    p_transfer.add_argument("--chunk-size", type=int, default=transfer.IMPORT_CHUNK_SIZE)
+
+    p_sess = sub.add_parser("sessions", help="複数セッションの同時保存 (書き込み専用スレッドと従来の保存) を比較")
+    p_sess.add_argument("--sessions", type=int, default=16)
+    p_sess.add_argument("--saves", type=int, default=20, help="セッションごとの保存回数")
+    p_sess.add_argument("--cards", type=int, default=20, help="1回の保存のカード枚数")
+    p_sess.add_argument("--rows", type=int, default=100_000, help="既存の連絡先の件数")
+
+    p_cache = sub.add_parser("cache", help="OCRキャッシュのヒット時の効果を計測")
+    p_cache.add_argument("--cards", type=int, default=50)
+    p_cache.add_argument("--latency", type=float, default=0.2)
+
+    p_sim = sub.add_parser("similar", help="知覚ハッシュ索引の検索時間と、変形画像とのハッシュの差を計測")
+    p_sim.add_argument("paths", nargs="*", help="ハッシュの差を確認する名刺画像")
+    p_sim.add_argument("--entries", type=int, default=10_000)
+    p_sim.add_argument("--queries", type=int, default=100)
+
+    p_pre = sub.add_parser("preprocess", help="画像前処理による送信バイト数の削減を計測")
+    p_pre.add_argument("paths", nargs="+")
+    p_pre.add_argument("--max-edge", type=int, default=preprocess.OCR_MAX_EDGE)
+
+    p_suite = sub.add_parser("suite", help="全ステージの p50/p99 とスループットをDB規模ごとに計測 (JSON出力)")
+    p_suite.add_argument("--sizes", type=int, nargs="+", default=[1000, 100_000, 1_000_000])
+    p_suite.add_argument("--cards", type=int, default=100, help="1回の呼び出しで扱うカード枚数")
+    p_suite.add_argument("--repeat", type=int, default=20)
+    p_suite.add_argument("--latency", type=float, default=0.2)
+    p_suite.add_argument("--jitter", type=float, default=0.1)
+    p_suite.add_argument("--error-rate", type=float, default=0.02)
+    p_suite.add_argument("--workers", type=int, default=8)
+    p_suite.add_argument("--data-dir", default=None, help="合成DBの保存先 (指定すると次回以降使い回す)")
+    p_suite.add_argument("--output", default=None, help="結果を書き出すJSONファイル")
+
+    args = parser.parse_args()
+    if args.target == "ocr":
+        bench_ocr(args.cards, args.latency, args.workers)
+    elif args.target == "batch":
+        bench_batch(args.cards, args.latency, args.workers, args.batch_size)
+    elif args.target == "ratelimit":
+        bench_ratelimit(args.cards, args.latency, args.workers, args.quota_rps)
+    elif args.target == "backends":
+        bench_backends(args.cards, args.latency, args.workers, args.local_rate)
+    elif args.target == "jobs":
+        bench_jobs(args.big, args.small, args.latency, args.workers, args.claim_size)
+    elif args.target == "checkdup":
+        bench_check_dup(args.cards, args.rows)
+    elif args.target == "save":
+        bench_save(args.rows)
+    elif args.target == "memory":
+        bench_memory(args.cards, args.image_kb, args.limit_mb, args.latency, args.workers)
+    elif args.target == "transfer":
+        bench_transfer(args.rows, args.chunk_size)
+    elif args.target == "sessions":
+        bench_sessions(args.sessions, args.saves, args.cards, args.rows)
+    elif args.target == "cache":
+        bench_cache(args.cards, args.latency)
+    elif args.target == "suite":
+        bench_suite(args.sizes, args.cards, args.repeat, args.latency, args.jitter, args.error_rate, args.workers,
+                    args.data_dir, args.output)
+    elif args.target == "similar":
+        bench_similar(args.entries, args.queries, args.paths)
+    elif args.target == "preprocess":
+        bench_preprocess(args.paths, args.max_edge)
+
+
+if __name__ == "__main__":
+    main()
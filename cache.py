@@ -0,0 +1,143 @@
+# cache.py
+# OCR結果のキャッシュ (画像バイト列のハッシュ + モデル名 + プロンプト版 をキーにする)
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+from models import Card
+from preprocess import hamming
+
+CACHE_PATH = os.environ.get("OCR_CACHE_PATH", "ocr_cache.db")
+# 保持する最大件数 (超えた分は最終利用が古いものから削除)
+CACHE_MAX_ENTRIES = int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "10000"))
+
+# 64ビットの知覚ハッシュを16ビットずつ4つに分けて索引する
+# ハミング距離3以下のハッシュは、4つのうち少なくとも1つが完全に一致するので索引で候補を絞り込める
+HASH_BANDS = 4
+
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_stats_lock = threading.Lock()
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+def stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+def init_cache():
+    os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+    with sqlite3.connect(CACHE_PATH) as con:
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_cache (
+                key         TEXT PRIMARY KEY,
+                card        TEXT NOT NULL,
+                created_at  REAL NOT NULL,
+                last_used   REAL NOT NULL
+            );
+        """)
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_used ON ocr_cache(last_used)")
+        # 解析済み画像の知覚ハッシュ (ほぼ同じ画像の解析結果を再利用するため)
+        # namespace: バックエンドの構成・プロンプト版など。モデルや設定を変えた後は古い解析結果と照合しない
+        columns = [r[1] for r in con.execute("PRAGMA table_info(image_hashes)")]
+        if columns and "namespace" not in columns:
+            # 以前の版の索引はどの設定の結果か分からないので作り直す
+            con.execute("DROP TABLE image_hashes")
+        bands = ", ".join(f"b{i} INTEGER" for i in range(HASH_BANDS))
+        con.execute(f"""CREATE TABLE IF NOT EXISTS image_hashes
+                        (key TEXT PRIMARY KEY, namespace TEXT NOT NULL, hash TEXT NOT NULL, {bands})""")
+        for i in range(HASH_BANDS):
+            con.execute(f"CREATE INDEX IF NOT EXISTS idx_image_hashes_ns_b{i} ON image_hashes(namespace, b{i})")
+
+def cache_key(image: bytes, model: str, prompt_version: str) -> str:
+    h = hashlib.sha256(image)
+    h.update(b"\0" + model.encode() + b"\0" + prompt_version.encode())
+    return h.hexdigest()
+
+def get_many(keys: List[str]) -> Dict[str, Card]:
+    if not keys:
+        return {}
+    init_cache()
+    unique = list(dict.fromkeys(keys))
+    found: Dict[str, Card] = {}
+    with sqlite3.connect(CACHE_PATH) as con:
+        # SQLiteのパラメータ上限を超えないよう分割して引く
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for key, card in con.execute(f"SELECT key, card FROM ocr_cache WHERE key IN ({marks})", chunk):
+                found[key] = json.loads(card)
+        if found:
+            now = time.time()
+            con.executemany("UPDATE ocr_cache SET last_used=? WHERE key=?", [(now, k) for k in found])
+    hits = sum(1 for k in keys if k in found)
+    _count("hits", hits)
+    _count("misses", len(keys) - hits)
+    return found
+
+def get(key: str) -> Optional[Card]:
+    return get_many([key]).get(key)
+
+def put_many(items: Dict[str, Card]):
+    # エラーになったカードはキャッシュしない (次回は再度APIに問い合わせる)
+    rows = [(k, json.dumps(c, ensure_ascii=False)) for k, c in items.items() if "error" not in c]
+    if not rows:
+        return
+    init_cache()
+    now = time.time()
+    with sqlite3.connect(CACHE_PATH) as con:
+        con.executemany(
+            """INSERT INTO ocr_cache (key, card, created_at, last_used) VALUES (?,?,?,?)
+               ON CONFLICT(key) DO UPDATE SET card=excluded.card, last_used=excluded.last_used""",
+            [(k, card, now, now) for k, card in rows],
+        )
+        total = con.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+        overflow = total - CACHE_MAX_ENTRIES
+        if overflow > 0:
+            con.execute("""DELETE FROM ocr_cache WHERE key IN (
+                               SELECT key FROM ocr_cache ORDER BY last_used LIMIT ?)""", (overflow,))
+            con.execute("DELETE FROM image_hashes WHERE key NOT IN (SELECT key FROM ocr_cache)")
+            _count("evictions", overflow)
+
+def put(key: str, card: Card):
+    put_many({key: card})
+
+def _bands(value: int) -> List[int]:
+    return [(value >> (16 * i)) & 0xFFFF for i in range(HASH_BANDS)]
+
+def put_hashes(items: Dict[str, int], namespace: str):
+    # キャッシュ済みの解析結果に、その画像の知覚ハッシュを対応付ける
+    if not items:
+        return
+    init_cache()
+    marks = ",".join("?" * HASH_BANDS)
+    with sqlite3.connect(CACHE_PATH) as con:
+        con.executemany(f"INSERT OR REPLACE INTO image_hashes VALUES (?, ?, ?, {marks})",
+                        [(k, namespace, format(h, "016x"), *_bands(h)) for k, h in items.items()])
+
+def find_similar(hashes: Dict[str, int], max_distance: int, namespace: str) -> Dict[str, Tuple[str, int]]:
+    # キー → 同じ namespace で知覚ハッシュが最も近い解析済み画像の (キー, 距離)。距離が max_distance 以下のもののみ
+    if not hashes or max_distance < 0:
+        return {}
+    init_cache()
+    where = " OR ".join(f"(h.namespace = ? AND h.b{i} = ?)" for i in range(HASH_BANDS))
+    found: Dict[str, Tuple[str, int]] = {}
+    with sqlite3.connect(CACHE_PATH) as con:
+        for key, value in hashes.items():
+            params = [p for band in _bands(value) for p in (namespace, band)]
+            rows = con.execute(f"""SELECT h.key, h.hash FROM image_hashes h JOIN ocr_cache c ON c.key = h.key
+                                   WHERE {where}""", params)
+            best = min(((hamming(value, int(h, 16)), k) for k, h in rows if k != key), default=None)
+            if best is not None and best[0] <= max_distance:
+                found[key] = (best[1], best[0])
+    return found
+
+def clear():
+    init_cache()
+    with sqlite3.connect(CACHE_PATH) as con:
+        con.execute("DELETE FROM ocr_cache")
+        con.execute("DELETE FROM image_hashes")
@@ -0,0 +1,251 @@
+# cli.py
+# ------------------------------------------------------------
+# 名刺画像フォルダの一括取り込み (Streamlitを使わないヘッドレス実行)
+#   python cli.py ingest ./scans --policy review
+# 中断しても、進捗DBに記録済みのファイルは次回スキップされる
+# UIから登録されたOCRジョブを処理するワーカー
+#   python cli.py worker --processes 2
+# 連絡先の一括エクスポート・インポート (CSV / vCard / JSONL)
+#   python cli.py export contacts.csv
+#   python cli.py import crm.jsonl
+# ------------------------------------------------------------
+import os
+import json
+import time
+import signal
+import sqlite3
+import argparse
+import logging
+import multiprocessing
+from typing import Dict, List
+
+import db
+import jobs
+import spool
+import transfer
+from graph import create_graph
+from ocr import iter_ocr
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+STATE_PATH = "ingest.db"
+
+
+def init_state(path: str):
+    with sqlite3.connect(path) as con:
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_files (
+                path        TEXT PRIMARY KEY,
+                size        INTEGER,
+                mtime       REAL,
+                status      TEXT,       -- done / review / failed
+                email       TEXT,
+                updated_at  REAL
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS review_queue (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                path        TEXT,
+                email       TEXT,
+                card        TEXT,
+                created_at  REAL
+            );
+        """)
+
+
+def finished_files(path: str) -> Dict[str, tuple]:
+    with sqlite3.connect(path) as con:
+        rows = con.execute("SELECT path, size, mtime FROM ingest_files WHERE status IN ('done', 'review')")
+        return {p: (size, mtime) for p, size, mtime in rows}
+
+
+def scan_images(root: str) -> List[str]:
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return sorted(paths)
+
+
+def record_chunk(path: str, files: List[spool.SpooledFile], cards, statuses: List[str], review: List[tuple]):
+    now = time.time()
+    with sqlite3.connect(path) as con:
+        rows = []
+        for f, card, status in zip(files, cards, statuses):
+            st = os.stat(f.path)
+            rows.append((f.path, st.st_size, st.st_mtime, status, card.get("email"), now))
+        con.executemany("""INSERT INTO ingest_files (path, size, mtime, status, email, updated_at)
+                           VALUES (?,?,?,?,?,?)
+                           ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime=excluded.mtime,
+                               status=excluded.status, email=excluded.email, updated_at=excluded.updated_at""",
+                        rows)
+        con.executemany("INSERT INTO review_queue (path, email, card, created_at) VALUES (?,?,?,?)",
+                        [(p, c.get("email"), json.dumps(c, ensure_ascii=False), now) for p, c in review])
+
+
+def ingest(root: str, policy: str, chunk_size: int, state_path: str, max_workers: int | None,
+           batch_size: int | None) -> Dict[str, float]:
+    db.init_db()
+    init_state(state_path)
+    graph = create_graph()
+
+    paths = scan_images(root)
+    done = finished_files(state_path)
+    todo = []
+    for p in paths:
+        st = os.stat(p)
+        if done.get(p) != (st.st_size, st.st_mtime):
+            todo.append(p)
+
+    summary = {"files": len(paths), "resumed_skip": len(paths) - len(todo), "processed": 0, "failed": 0,
+               "inserted": 0, "updated": 0, "dup_skipped": 0, "queued_for_review": 0}
+    print(f"対象 {len(paths)} 枚 (処理済み {summary['resumed_skip']} 枚をスキップ)")
+
+    started = time.perf_counter()
+    for start in range(0, len(todo), chunk_size):
+        chunk_started = time.perf_counter()
+        # 画像は必要になった時点でディスクから読む
+        files = [spool.SpooledFile(os.path.basename(p), p, os.path.getsize(p)) for p in todo[start:start + chunk_size]]
+        cards = [None] * len(files)
+        # 確認する画面が無いので、ほぼ同じ画像でも解析結果は再利用しない (似た画像は知らせるだけ)
+        for i, card in iter_ocr(files, max_workers=max_workers, batch_size=batch_size, reuse_similar=False):
+            cards[i] = card
+            similar = card.get("similar_to")
+            if similar:
+                source = similar.get("name") if similar["source"] == "batch" else "以前に解析した画像"
+                print(f"  注意: {files[i].name} は {source} とほぼ同じ画像です (差異 {similar['distance']})")
+
+        # 解析に失敗したカードは保存せず、次回の実行で再処理する
+        ok = [c for c in cards if "error" not in c]
+        # 重複時の扱いを事前に決めておくので、gateで止まらずに保存まで進む
+        decision = "overwrite" if policy == "overwrite" else "skip"
+        state = graph.invoke({"cards": ok, "default_decision": decision}) if ok else {"cards": [], "dup_cards": [], "saved": {}}
+
+        # state["cards"] は ok と同じ順で、重複判定の結果 (正規化・duplicate_of) が反映されている
+        dup_emails = {c["email"] for c in state["dup_cards"] if c.get("email")}
+        dup_flags = iter([bool(c.get("email") in dup_emails or "duplicate_of" in c) for c in state["cards"]])
+        statuses, review = [], []
+        for f, card in zip(files, cards):
+            if "error" in card:
+                statuses.append("failed")
+            elif next(dup_flags) and policy == "review":
+                statuses.append("review")
+                review.append((f.path, card))
+            else:
+                statuses.append("done")
+        record_chunk(state_path, files, cards, statuses, review)
+
+        saved = state.get("saved", {})
+        summary["processed"] += len(files)
+        summary["failed"] += statuses.count("failed")
+        summary["inserted"] += saved.get("inserted", 0)
+        summary["updated"] += saved.get("updated", 0)
+        if policy == "skip":
+            summary["dup_skipped"] += len(state["dup_cards"])
+        summary["queued_for_review"] += len(review)
+
+        elapsed = time.perf_counter() - chunk_started
+        total_elapsed = time.perf_counter() - started
+        print(f"[{summary['processed']}/{len(todo)}] {len(files)} 枚 {elapsed:.1f}秒 "
+              f"({len(files) / elapsed:.2f} 枚/秒, 累計 {summary['processed'] / total_elapsed:.2f} 枚/秒)")
+
+    total_elapsed = time.perf_counter() - started
+    summary["elapsed_sec"] = round(total_elapsed, 2)
+    summary["cards_per_sec"] = round(summary["processed"] / total_elapsed, 2) if summary["processed"] else 0.0
+    return summary
+
+
+def _worker_process(**kwargs):
+    try:
+        jobs.work(**kwargs)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(processes: int, max_workers: int | None, batch_size: int | None, claim_size: int | None,
+                poll: float):
+    # プロセスごとに max_workers 本までAPIリクエストを並列に送る
+    kwargs = {"max_workers": max_workers, "batch_size": batch_size, "claim_size": claim_size, "poll_interval": poll}
+    if processes <= 1:
+        jobs.work(**kwargs)
+        return
+    procs = [multiprocessing.Process(target=_worker_process, kwargs=kwargs) for _ in range(processes)]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        # 子プロセスも処理中のタスクをキューに戻してから終了させる
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGINT)
+        for p in procs:
+            p.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="名刺画像フォルダの一括OCR取り込み")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_ingest = sub.add_parser("ingest", help="フォルダ内の名刺画像をOCRしてDBに保存")
+    p_ingest.add_argument("directory")
+    p_ingest.add_argument("--policy", choices=["overwrite", "skip", "review"], default="review",
+                          help="既存の連絡先と重複した場合の扱い (review: 保存せずレビュー待ちに記録)")
+    p_ingest.add_argument("--chunk-size", type=int, default=50, help="1回の保存にまとめる枚数")
+    p_ingest.add_argument("--state", default=STATE_PATH, help="進捗を記録するSQLiteファイル")
+    p_ingest.add_argument("--db", default=db.DB_PATH, help="保存先の連絡先DB")
+    p_ingest.add_argument("--workers", type=int, default=None, help="OCRの同時実行数")
+    p_ingest.add_argument("--batch-size", type=int, default=None, help="1リクエストにまとめる枚数")
+
+    p_worker = sub.add_parser("worker", help="UIから登録されたOCRジョブを処理する")
+    p_worker.add_argument("--processes", type=int, default=1, help="ワーカープロセス数")
+    p_worker.add_argument("--workers", type=int, default=None, help="プロセスごとのOCRの同時実行数 (スレッド数)")
+    p_worker.add_argument("--batch-size", type=int, default=None, help="1リクエストにまとめる枚数")
+    p_worker.add_argument("--claim-size", type=int, default=None, help="1スレッドが1回にキューから取り出す枚数 (省略時は1リクエスト分)")
+    p_worker.add_argument("--poll", type=float, default=0.5, help="キューが空の時の確認間隔 (秒)")
+
+    p_export = sub.add_parser("export", help="連絡先をファイルに書き出す")
+    p_export.add_argument("path")
+    p_export.add_argument("--format", choices=transfer.FORMATS, default=None, help="省略時は拡張子から判定")
+    p_export.add_argument("--db", default=db.DB_PATH, help="連絡先DB")
+
+    p_import = sub.add_parser("import", help="ファイルの連絡先をメールアドレスをキーに一括upsertする")
+    p_import.add_argument("path")
+    p_import.add_argument("--format", choices=transfer.FORMATS, default=None, help="省略時は拡張子から判定")
+    p_import.add_argument("--db", default=db.DB_PATH, help="連絡先DB")
+    p_import.add_argument("--chunk-size", type=int, default=transfer.IMPORT_CHUNK_SIZE,
+                          help="1トランザクションで保存する件数")
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+        try:
+            run_workers(args.processes, args.workers, args.batch_size, args.claim_size, args.poll)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "ingest":
+        db.DB_PATH = args.db
+        summary = ingest(args.directory, args.policy, args.chunk_size, args.state, args.workers, args.batch_size)
+        print("取り込み完了:")
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    elif args.command == "export":
+        db.DB_PATH = args.db
+        started = time.perf_counter()
+        result = transfer.export_contacts(args.path, args.format)
+        print(f"{result['rows']} 件を書き出しました ({time.perf_counter() - started:.1f}秒)")
+    elif args.command == "import":
+        db.DB_PATH = args.db
+        started = time.perf_counter()
+
+        def progress(summary):
+            print(f"[{summary['rows']}] 新規 {summary['inserted']} 件 / 更新 {summary['updated']} 件 "
+                  f"({summary['rows'] / (time.perf_counter() - started):.0f} 件/秒)")
+        summary = transfer.import_contacts(args.path, args.format, args.chunk_size, progress)
+        print("インポート完了:")
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
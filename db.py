@@ -1,14 +1,220 @@
 # db.py
 import os
+import re
+import time
+import unicodedata
+import queue
+import logging
 import sqlite3
-from typing import List
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Set
 from models import Card
+import metrics
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "contacts.db"
 
+# 書き込み専用スレッドが1回のコミットにまとめる最大行数 (複数セッションの save_cards をまとめてコミットする)
+DB_WRITE_BATCH_ROWS = int(os.environ.get("DB_WRITE_BATCH_ROWS", "5000"))
+# 1回の保存がこの行数以上なら、全文検索の同期トリガーを外して保存し、索引をまとめて作り直す
+# (トリガーで1行ずつ索引を更新すると、大量の取り込みが数倍遅くなる。作り直しは表全体に比例するので小さな保存では使わない)
+DB_FTS_REBUILD_ROWS = int(os.environ.get("DB_FTS_REBUILD_ROWS", "10000"))
+# 読み取り専用接続のプールに保持する接続数
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "8"))
+
+# 全文検索の対象列 (contacts_fts はこの順で列を持つ)
+CARD_FIELDS = ["name", "company", "email", "phone", "department", "job_title", "qualification",
+               "company_address", "company_url", "company_phone", "company_fax"]
+
+# 重複候補の絞り込み用ブロッキングキー (保存時に計算して索引を張る)
+KEY_FIELDS = ["phone_key", "name_key", "domain_key"]
+
+# 会社名の比較で無視する法人格の表記
+_COMPANY_SUFFIXES = re.compile(r"株式会社|有限会社|合同会社|\(株\)|\(有\)|co\.?,?\s*ltd\.?|inc\.?|corp(oration)?\.?|llc")
+
+# 一覧の並び順として指定できる列 (NULLを空文字として扱い、キーセットの比較を成立させる)
+ORDER_COLUMNS = {
+    "id": "id",
+    "name": "IFNULL(name, '')",
+    "company": "IFNULL(company, '')",
+    "email": "IFNULL(email, '')",
+}
+
+CONTACT_COLUMNS = """name, company, email, phone, department, job_title, 
+                   qualification, company_address, company_url, company_phone, company_fax"""
+
+# 一覧・件数・検索結果のプロセス内キャッシュ (save_cards のコミット時に破棄する)
+# 他プロセス (CLIなど) の書き込みは検知できないため、TTLで古い結果を捨てる
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 60.0
+_query_cache: "OrderedDict[tuple, tuple[float, object]]" = OrderedDict()
+_query_cache_lock = threading.Lock()
+# invalidate_cache のたびに増やす。読み込み中に破棄された場合は、読んだ (コミット前の) 値をキャッシュしない
+_query_cache_generation = 0
+
+def invalidate_cache():
+    global _query_cache_generation
+    with _query_cache_lock:
+        _query_cache.clear()
+        _query_cache_generation += 1
+
+def _cached(key: tuple, load: Callable[[], object]):
+    key = (DB_PATH,) + key
+    now = time.monotonic()
+    with _query_cache_lock:
+        hit = _query_cache.get(key)
+        if hit is not None and now - hit[0] < QUERY_CACHE_TTL:
+            _query_cache.move_to_end(key)
+            return hit[1]
+        generation = _query_cache_generation
+    value = load()
+    with _query_cache_lock:
+        if generation != _query_cache_generation:
+            return value
+        _query_cache[key] = (now, value)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return value
+
+def _tune(con: sqlite3.Connection) -> sqlite3.Connection:
+    # 読み書き共通の接続ごとの設定
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-32000")
+    return con
+
+def connect(path: str | None = None, check_same_thread: bool = True) -> sqlite3.Connection:
+    con = sqlite3.connect(path or DB_PATH, timeout=30, check_same_thread=check_same_thread)
+    # 接続ごとの設定 (WALと組み合わせて書き込みのfsyncを減らす)
+    con.execute("PRAGMA synchronous=NORMAL")
+    return _tune(con)
+
+# ---- 読み取り専用接続のプール ----
+# WALでは読み取りは書き込みを待たないので、接続を使い回して接続・PRAGMAのコストを省く
+
+_read_pools: Dict[str, "queue.LifoQueue[sqlite3.Connection]"] = {}
+_pools_lock = threading.Lock()
+
+def _open_reader(path: str) -> sqlite3.Connection:
+    return _tune(sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, timeout=30,
+                                 check_same_thread=False))
+
+@contextmanager
+def reading() -> Iterator[sqlite3.Connection]:
+    # プールから接続を借りて返す (空なら新しく開き、プールが一杯なら閉じる)
+    path = DB_PATH
+    with _pools_lock:
+        pool = _read_pools.setdefault(path, queue.LifoQueue())
+    try:
+        con = pool.get_nowait()
+    except queue.Empty:
+        con = _open_reader(path)
+    try:
+        yield con
+    finally:
+        if con.in_transaction:
+            con.rollback()
+        if pool.qsize() < DB_READ_POOL_SIZE:
+            pool.put(con)
+        else:
+            con.close()
+
+# ---- 書き込み専用スレッド (グループコミット) ----
+# 全セッションの save_cards をキューで受け取り、1本の接続でまとめてコミットする
+# 書き込みロックの取り合い (database is locked) と、バッチごとのコミットのコストを避ける
+
+class _Writer:
+    def __init__(self, path: str):
+        self.path = path
+        self.queue: "queue.Queue[tuple[Dict[str, tuple], Dict[int, tuple], Future]]" = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"db-writer:{path}", daemon=True)
+        self.thread.start()
+
+    def submit(self, rows: Dict[str, tuple], updates: Dict[int, tuple] | None = None) -> Future:
+        future: Future = Future()
+        self.queue.put((rows, updates or {}, future))
+        return future
+
+    def _take(self) -> list:
+        # 待っている依頼を DB_WRITE_BATCH_ROWS 行まで取り出す (最初の1件は待つ)
+        items = [self.queue.get()]
+        size = len(items[0][0]) + len(items[0][1])
+        while size < DB_WRITE_BATCH_ROWS:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            size += len(item[0]) + len(item[1])
+        return items
+
+    def _run(self):
+        con = connect(self.path, check_same_thread=False)
+        while True:
+            items = self._take()
+            started = time.perf_counter()
+            try:
+                with con:
+                    con.execute("BEGIN IMMEDIATE")
+                    results = [_save(con, rows, updates) for rows, updates, _ in items]
+            except Exception as e:
+                # まとめたうちのどれかが失敗した場合は、1件ずつコミットし直して失敗した依頼だけにエラーを返す
+                logger.warning("グループコミットに失敗したため1件ずつ保存します: %s", e)
+                committed = []
+                for rows, updates, future in items:
+                    try:
+                        with con:
+                            con.execute("BEGIN IMMEDIATE")
+                            result = _save(con, rows, updates)
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+                    else:
+                        committed.append((future, result))
+                # 保存できた依頼があれば、結果を返す前にキャッシュを破棄する (呼び出し側が直後に一覧を読んでも古くならない)
+                if committed:
+                    invalidate_cache()
+                for future, result in committed:
+                    future.set_result(result)
+                continue
+            invalidate_cache()
+            metrics.record("db.group_commit", (time.perf_counter() - started) * 1000,
+                           batches=len(items), rows=sum(len(rows) + len(updates) for rows, updates, _ in items))
+            for (_, _, future), result in zip(items, results):
+                future.set_result(result)
+
+_writers: Dict[str, _Writer] = {}
+
+def _writer() -> _Writer:
+    with _pools_lock:
+        writer = _writers.get(DB_PATH)
+        if writer is None:
+            writer = _writers[DB_PATH] = _Writer(DB_PATH)
+        return writer
+
+def _create_fts_triggers(con: sqlite3.Connection):
+    cols = ", ".join(CARD_FIELDS)
+    new_cols = ", ".join(f"new.{f}" for f in CARD_FIELDS)
+    old_cols = ", ".join(f"old.{f}" for f in CARD_FIELDS)
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS contacts_fts_ai AFTER INSERT ON contacts BEGIN
+                        INSERT INTO contacts_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END""")
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS contacts_fts_ad AFTER DELETE ON contacts BEGIN
+                        INSERT INTO contacts_fts(contacts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    END""")
+    con.execute(f"""CREATE TRIGGER IF NOT EXISTS contacts_fts_au AFTER UPDATE ON contacts BEGIN
+                        INSERT INTO contacts_fts(contacts_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                        INSERT INTO contacts_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END""")
+
 def init_db():
     os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
-    with sqlite3.connect(DB_PATH) as con:
+    with connect() as con:
+        # WALはDBファイルに記録されるので初期化時に1度設定すればよい
+        con.execute("PRAGMA journal_mode=WAL")
         con.execute("""
             CREATE TABLE IF NOT EXISTS contacts (
                 id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -25,54 +231,272 @@ def init_db():
                 company_fax     TEXT
             );
         """)
+        # 表記ゆれ (前後の空白・大文字小文字) を吸収した照合用の式インデックス
+        con.execute("CREATE INDEX IF NOT EXISTS idx_contacts_email_norm ON contacts(lower(trim(email)))")
+        # 一覧のキーセットページング用 (ORDER_COLUMNS と同じ式で索引を張る)
+        for col in ("name", "company", "email"):
+            con.execute(f"CREATE INDEX IF NOT EXISTS idx_contacts_order_{col} ON contacts({ORDER_COLUMNS[col]})")
+        # 日本語の部分一致検索用の全文検索インデックス (トリグラム)。contacts とはトリガーで同期する
+        created = con.execute("SELECT 1 FROM sqlite_master WHERE name='contacts_fts'").fetchone() is None
+        con.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+                            {', '.join(CARD_FIELDS)}, content='contacts', content_rowid='id', tokenize='trigram')""")
+        _create_fts_triggers(con)
+        if created:
+            # 既存データから索引を作り直す
+            con.execute("INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')")
+        # ブロッキングキー列 (旧バージョンのDBには列を追加して既存行を埋める)
+        existing_cols = {r[1] for r in con.execute("PRAGMA table_info(contacts)")}
+        for col in KEY_FIELDS:
+            if col not in existing_cols:
+                con.execute(f"ALTER TABLE contacts ADD COLUMN {col} TEXT")
+            con.execute(f"CREATE INDEX IF NOT EXISTS idx_contacts_{col} ON contacts({col})")
+        # 既存行の移行は user_version で1度だけ行う (init_db は毎回の再描画で呼ばれるので全件走査を繰り返さない)
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            rows = con.execute(f"SELECT id, {', '.join(CARD_FIELDS)} FROM contacts").fetchall()
+            con.executemany(
+                f"UPDATE contacts SET {', '.join(f'{k}=?' for k in KEY_FIELDS)} WHERE id=?",
+                [blocking_keys(dict(zip(CARD_FIELDS, r[1:]))) + (r[0],) for r in rows],
+            )
+        if version < 2:
+            # 旧バージョンで保存された未正規化のメールアドレスを揃え、ON CONFLICT(email) で照合できるようにする
+            con.execute("""UPDATE OR IGNORE contacts SET email = lower(trim(email))
+                           WHERE email IS NOT NULL AND email <> lower(trim(email))""")
+            con.execute("PRAGMA user_version=2")
+
+def normalize_email(email: str | None) -> str | None:
+    if email is None:
+        return None
+    email = email.strip().lower()
+    return email or None
+
+def normalize_text(text: str | None) -> str:
+    # 全角半角を揃え、空白を除いて小文字にする
+    if not text:
+        return ""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", text)).lower()
+
+def normalize_company(company: str | None) -> str:
+    return _COMPANY_SUFFIXES.sub("", normalize_text(company)).strip(".,・")
+
+def phone_key(phone: str | None) -> str | None:
+    digits = re.sub(r"\D", "", unicodedata.normalize("NFKC", phone or ""))
+    # 国番号 +81 は国内表記 (先頭0) に揃える
+    if digits.startswith("81") and len(digits) in (11, 12):
+        digits = "0" + digits[2:]
+    return digits if len(digits) >= 9 else None
+
+def url_domain(url: str | None) -> str | None:
+    host = re.sub(r"^[a-z]+://", "", normalize_text(url)).split("/")[0].split(":")[0]
+    host = host.removeprefix("www.")
+    return host if "." in host else None
+
+def blocking_keys(card: Card) -> tuple:
+    name, company = normalize_text(card.get("name")), normalize_company(card.get("company"))
+    return (
+        phone_key(card.get("phone")),
+        f"{company}|{name}" if company and name else None,
+        url_domain(card.get("company_url")),
+    )
+
+def _existing_emails(con: sqlite3.Connection, keys: List[str]) -> Set[str]:
+    found: Set[str] = set()
+    # SQLiteのパラメータ上限を超えないよう分割して引く
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        rows = con.execute(f"SELECT lower(trim(email)) FROM contacts WHERE lower(trim(email)) IN ({marks})", chunk)
+        found.update(r[0] for r in rows)
+    return found
+
+def existing_emails(emails: Iterable[str]) -> Set[str]:
+    # まとめて1接続で照会し、DBに存在する (正規化済み) メールアドレスの集合を返す
+    keys = list({e for e in map(normalize_email, emails) if e})
+    if not keys:
+        return set()
+    with reading() as con:
+        return _existing_emails(con, keys)
 
 def exists(email: str) -> bool:
-    with sqlite3.connect(DB_PATH) as con:
-        return con.execute("SELECT 1 FROM contacts WHERE email=?", (email,)).fetchone() is not None
-
-def save_cards(cards: List[Card]):
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
-        for c in cards:
-            # 安全にフィールド取得
-            name = c.get("name", "")
-            company = c.get("company", "")
-            email = c.get("email", None)
-            phone = c.get("phone", "")
-            department = c.get("department", "")
-            job_title = c.get("job_title", "")
-            qualification = c.get("qualification", "")
-            company_address = c.get("company_address", "")
-            company_url = c.get("company_url", "")
-            company_phone = c.get("company_phone", "")
-            company_fax = c.get("company_fax", "")
-            
-            # メールアドレスがない場合は保存しない
-            if not email:
-                continue
-                
-            # 重複チェック
-            if exists(email):
-                cur.execute("""UPDATE contacts
-                           SET name=?, company=?, phone=?, department=?, 
-                               job_title=?, qualification=?, company_address=?,
-                               company_url=?, company_phone=?, company_fax=?
-                           WHERE email=?""",
-                        (name, company, phone, department, job_title, qualification,
-                         company_address, company_url, company_phone, company_fax, email))
+    with reading() as con:
+        return con.execute("SELECT 1 FROM contacts WHERE lower(trim(email))=?",
+                           (normalize_email(email),)).fetchone() is not None
+
+def _upsert(con: sqlite3.Connection, rows: Dict[str, tuple]) -> Dict[str, int]:
+    # 書き込みロックを取った接続で呼ぶ (件数の集計とupsertの間に他の書き込みが入らないように)
+    updated = len(_existing_emails(con, list(rows)))
+    con.executemany("""INSERT INTO contacts
+                       (name, company, email, phone, department, job_title, qualification,
+                        company_address, company_url, company_phone, company_fax,
+                        phone_key, name_key, domain_key)
+                       VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                       ON CONFLICT(email) DO UPDATE SET
+                           name=excluded.name, company=excluded.company, phone=excluded.phone,
+                           department=excluded.department, job_title=excluded.job_title,
+                           qualification=excluded.qualification, company_address=excluded.company_address,
+                           company_url=excluded.company_url, company_phone=excluded.company_phone,
+                           company_fax=excluded.company_fax, phone_key=excluded.phone_key,
+                           name_key=excluded.name_key, domain_key=excluded.domain_key""",
+                    rows.values())
+    return {"inserted": len(rows) - updated, "updated": updated}
+
+def _update_by_id(con: sqlite3.Connection, updates: Dict[int, tuple]) -> tuple[int, Dict[str, tuple]]:
+    # あいまい一致で上書きを選んだカードを、一致した既存連絡先の id をキーに更新する
+    # メールアドレスはカードに無い場合・他の連絡先が使っている場合は既存の値を残す
+    # 戻り値: (更新した件数, 行が削除されていて更新できなかったカードの行 (メールアドレスでupsertし直す))
+    updated, missing = 0, {}
+    for contact_id, row in updates.items():
+        cur = con.execute("""UPDATE contacts SET
+                                 name=?1, company=?2,
+                                 email=CASE WHEN ?3 IS NULL
+                                              OR EXISTS(SELECT 1 FROM contacts WHERE email=?3 AND id<>?15)
+                                            THEN email ELSE ?3 END,
+                                 phone=?4, department=?5, job_title=?6, qualification=?7,
+                                 company_address=?8, company_url=?9, company_phone=?10, company_fax=?11,
+                                 phone_key=?12, name_key=?13, domain_key=?14
+                             WHERE id=?15""", row + (contact_id,))
+        if cur.rowcount:
+            updated += 1
+        elif row[2]:
+            missing[row[2]] = row
+    return updated, missing
+
+def _save(con: sqlite3.Connection, rows: Dict[str, tuple], updates: Dict[int, tuple]) -> Dict[str, int]:
+    if len(rows) + len(updates) >= DB_FTS_REBUILD_ROWS:
+        # 大量の保存はトリガーを外して書き込み、最後に索引を作り直す
+        # (同じトランザクション内なので、他の接続からはトリガーが無い状態は見えない)
+        for name in ("ai", "ad", "au"):
+            con.execute(f"DROP TRIGGER IF EXISTS contacts_fts_{name}")
+        result = _save_rows(con, rows, updates)
+        con.execute("INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')")
+        _create_fts_triggers(con)
+        return result
+    return _save_rows(con, rows, updates)
+
+def _save_rows(con: sqlite3.Connection, rows: Dict[str, tuple], updates: Dict[int, tuple]) -> Dict[str, int]:
+    updated, missing = _update_by_id(con, updates) if updates else (0, {})
+    result = _upsert(con, {**missing, **rows}) if missing or rows else {"inserted": 0, "updated": 0}
+    return {"inserted": result["inserted"], "updated": result["updated"] + updated}
+
+def _card_row(c: Card, email: str | None) -> tuple:
+    return tuple(email if f == "email" else c.get(f, "") for f in CARD_FIELDS) + blocking_keys(c)
+
+def _card_rows(cards: List[Card]) -> Dict[str, tuple]:
+    # 正規化したメールアドレス → contacts に書き込む値
+    rows: Dict[str, tuple] = {}
+    for c in cards:
+        email = normalize_email(c.get("email", None))
+        # メールアドレスがない場合は保存しない
+        if not email:
+            continue
+        # 同じバッチ内で重複した場合は後のカードを優先
+        rows[email] = _card_row(c, email)
+    return rows
+
+def save_cards(cards: List[Card], updates: Dict[int, Card] | None = None) -> Dict[str, int]:
+    # メールアドレスをキーに一括upsertし、新規/更新の件数を返す
+    # updates: 既存連絡先の id → その行に上書きするカード (あいまい一致の上書き。メールアドレスが無くても更新する)
+    # 書き込みは書き込み専用スレッドが行い、同時に届いた他のセッションの保存と1回のコミットにまとめる
+    rows = _card_rows(cards)
+    by_id = {i: _card_row(c, normalize_email(c.get("email", None))) for i, c in (updates or {}).items()}
+    if not rows and not by_id:
+        return {"inserted": 0, "updated": 0}
+    # コミットされてから (一覧のキャッシュも破棄されてから) 戻る
+    return _writer().submit(rows, by_id).result()
+
+def find_candidates(keys: Dict[str, Set[str]]) -> List[dict]:
+    # ブロッキングキーのいずれかが一致する既存連絡先を索引経由で引く (表全体は走査しない)
+    # keys: {"phone_key": {...}, "name_key": {...}, "domain_key": {...}}
+    found: Dict[int, dict] = {}
+    with reading() as con:
+        for col in KEY_FIELDS:
+            values = [v for v in keys.get(col, ()) if v]
+            for i in range(0, len(values), 500):
+                chunk = values[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                cur = con.execute(f"""SELECT id, {', '.join(CARD_FIELDS + KEY_FIELDS)} FROM contacts
+                                      WHERE {col} IN ({marks}) AND email IS NOT NULL""", chunk)
+                for r in cur:
+                    found[r[0]] = dict(zip(["id"] + CARD_FIELDS + KEY_FIELDS, r))
+    return list(found.values())
+
+def _search_clause(query: str) -> tuple[str, list]:
+    # トリグラムは3文字以上で索引が効く。2文字以下 (「田中」など) は各列の LIKE で照合する
+    if len(query) >= 3:
+        phrase = '"' + query.replace('"', '""') + '"'
+        return "id IN (SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ?)", [phrase]
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    clause = " OR ".join(f"{f} LIKE ? ESCAPE '\\'" for f in CARD_FIELDS)
+    return f"({clause})", [pattern] * len(CARD_FIELDS)
+
+def search_contacts(query: str, limit: int = 100, offset: int = 0):
+    # 全文検索インデックスで部分一致検索する (全列が対象、大文字小文字は区別しない)
+    query = query.strip()
+
+    def load():
+        where, params = _search_clause(query)
+        with reading() as con:
+            return con.execute(f"""
+                SELECT {CONTACT_COLUMNS}
+                FROM contacts WHERE {where} ORDER BY id LIMIT ? OFFSET ?
+            """, params + [limit, offset]).fetchall()
+    return _cached(("search", query, limit, offset), load)
+
+def count_contacts(query: str | None = None) -> int:
+    query = (query or "").strip()
+
+    def load():
+        with reading() as con:
+            if not query:
+                return con.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+            where, params = _search_clause(query)
+            return con.execute(f"SELECT COUNT(*) FROM contacts WHERE {where}", params).fetchone()[0]
+    return _cached(("count", query), load)
+
+def list_contacts(after_id: int | None = None, limit: int = 100, order_by: str = "id"):
+    # キーセットページング: 前ページ最後の行 (after_id) より後ろを limit 件返す
+    # 先頭列は id (次ページの after_id に使う)。ページ位置に関わらずコストは limit に比例する
+    if order_by not in ORDER_COLUMNS:
+        raise ValueError(f"order_by must be one of {list(ORDER_COLUMNS)}")
+    key = ORDER_COLUMNS[order_by]
+
+    def load():
+        with reading() as con:
+            if after_id is None:
+                where, params = "", []
+            elif order_by == "id":
+                where, params = "WHERE id > ?", [after_id]
             else:
-                cur.execute("""INSERT INTO contacts
-                           (name, company, email, phone, department, job_title, qualification,
-                            company_address, company_url, company_phone, company_fax)
-                           VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-                        (name, company, email, phone, department, job_title, qualification,
-                         company_address, company_url, company_phone, company_fax))
-        con.commit()
+                anchor = con.execute(f"SELECT {key} FROM contacts WHERE id = ?", (after_id,)).fetchone()
+                if anchor is None:
+                    return []
+                # (key, id) > (anchor, after_id) を索引の範囲検索が効く形で書く
+                where = f"WHERE {key} >= ? AND ({key} > ? OR id > ?)"
+                params = [anchor[0], anchor[0], after_id]
+            return con.execute(f"""
+                SELECT id, {CONTACT_COLUMNS}
+                FROM contacts {where} ORDER BY {key}, id LIMIT ?
+            """, params + [limit]).fetchall()
+    return _cached(("list", after_id, limit, order_by), load)
 
 def get_all_contacts():
-    with sqlite3.connect(DB_PATH) as con:
-        return con.execute("""
-            SELECT name, company, email, phone, department, job_title, 
-                   qualification, company_address, company_url, company_phone, company_fax 
+    with reading() as con:
+        return con.execute(f"""
+            SELECT {CONTACT_COLUMNS} 
             FROM contacts
         """).fetchall()
+
+def iter_contacts(chunk_size: int = 1000) -> Iterator[Card]:
+    # 全件をid順に返す。カーソルから chunk_size 件ずつ読むので、件数が多くてもメモリは増えない
+    with reading() as con:
+        cur = con.execute(f"SELECT {', '.join(CARD_FIELDS)} FROM contacts ORDER BY id")
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield dict(zip(CARD_FIELDS, r))
+        finally:
+            # 途中で読み捨てられても読み取りのスナップショットを残さずに接続をプールへ返す
+            cur.close()
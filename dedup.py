@@ -0,0 +1,67 @@
+# dedup.py
+# メールアドレス以外の手がかりによるあいまい重複検出
+# ブロッキングキー (電話番号・会社名+氏名・会社URLドメイン) が一致する候補だけを索引で引き、
+# その中でのみ類似度を計算する
+from difflib import SequenceMatcher
+from typing import Dict, List
+from models import Card, DuplicateMatch
+from db import KEY_FIELDS, blocking_keys, find_candidates, normalize_company, normalize_text
+
+# この値以上の類似度なら重複候補として扱う
+FUZZY_DUP_THRESHOLD = 0.8
+
+def _similarity(a: str | None, b: str | None) -> float | None:
+    a, b = normalize_text(a), normalize_text(b)
+    if not a or not b:
+        return None
+    return SequenceMatcher(None, a, b).ratio()
+
+def score(card: Card, keys: tuple, candidate: dict) -> tuple[float, str]:
+    phone, name_key, domain = keys
+    name_sim = _similarity(card.get("name"), candidate["name"])
+    best, reason = 0.0, ""
+    if name_key and name_key == candidate["name_key"]:
+        best, reason = 0.95, "会社名+氏名"
+    if phone and phone == candidate["phone_key"]:
+        # 同じ電話番号でも氏名が大きく異なる場合は別人とみなす
+        s = 0.85 if name_sim is None else 0.6 + 0.4 * name_sim
+        if s > best:
+            best, reason = s, "電話番号"
+    if domain and domain == candidate["domain_key"] and name_sim is not None:
+        # 同じ会社の別の社員と区別するため、氏名の類似度を重視する
+        company_sim = 1.0 if normalize_company(card.get("company")) == normalize_company(candidate["company"]) else 0.9
+        s = name_sim * company_sim
+        if s > best:
+            best, reason = s, "会社URL+氏名"
+    return best, reason
+
+def find_fuzzy_duplicates(cards: List[Card], threshold: float | None = None) -> Dict[int, DuplicateMatch]:
+    # cards のインデックス → 最も近い既存連絡先 (類似度が閾値以上のもののみ)
+    threshold = FUZZY_DUP_THRESHOLD if threshold is None else threshold
+    keys = [blocking_keys(c) for c in cards]
+    lookup = {col: {k[i] for k in keys if k[i]} for i, col in enumerate(KEY_FIELDS)}
+    if not any(lookup.values()):
+        return {}
+
+    # ブロックごとに候補をまとめ、カードは自分のブロックの候補とだけ比較する
+    blocks: Dict[tuple, List[dict]] = {}
+    for cand in find_candidates(lookup):
+        for col in KEY_FIELDS:
+            if cand[col]:
+                blocks.setdefault((col, cand[col]), []).append(cand)
+
+    matches: Dict[int, DuplicateMatch] = {}
+    for i, (card, k) in enumerate(zip(cards, keys)):
+        seen, best = set(), None
+        for col, value in zip(KEY_FIELDS, k):
+            for cand in blocks.get((col, value), []) if value else []:
+                if cand["id"] in seen:
+                    continue
+                seen.add(cand["id"])
+                s, reason = score(card, k, cand)
+                if s >= threshold and (best is None or s > best["score"]):
+                    best = {"id": cand["id"], "email": cand["email"], "name": cand["name"],
+                            "company": cand["company"], "score": round(s, 3), "reason": reason}
+        if best is not None:
+            matches[i] = best
+    return matches
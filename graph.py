@@ -1,54 +1,120 @@
 # graph.py
+import os
+import time
+import uuid
+import logging
+import sqlite3
+from typing import List, Tuple
 from langgraph.graph import StateGraph
-from langgraph.types import interrupt
-from models import State
-from db import exists, save_cards
+from langgraph.types import Command, interrupt
+from models import Card, State
+from db import existing_emails, normalize_email, save_cards
+from dedup import find_fuzzy_duplicates
+from metrics import timed
 
+logger = logging.getLogger(__name__)
+
+# 重複確認で一時停止したバッチの保存先 (再起動後もOCRをやり直さずに再開できる)
+CHECKPOINT_PATH = os.environ.get("GRAPH_CHECKPOINT_PATH", "checkpoints.db")
+# 重複確認待ちのまま、この秒数が過ぎたバッチはチェックポイントごと削除する
+GRAPH_BATCH_TTL_SEC = float(os.environ.get("GRAPH_BATCH_TTL_SEC", "604800"))
+
+def dup_key(card: Card) -> str:
+    # 重複カードの決定 (decisions) のキー。check_dup が dup_cards 内の位置から付ける
+    # (同じ連絡先に一致したカードが複数あっても、メールアドレスが無くてもキーが衝突しない)
+    if card.get("dup_key"):
+        return card["dup_key"]
+    # dup_key を付ける前の版で一時停止したバッチ
+    if card.get("email"):
+        return card["email"]
+    return f"id:{card['duplicate_of']['id']}"
+
+@timed("graph.check_dup")
 def check_dup(state: State) -> State:
-    new_, dup_ = [], []
+    # メールアドレスを正規化してから、バッチ全体を1回の問い合わせで照合する
+    cards = []
     for c in state["cards"]:
-        # デバッグ表示も安全に処理
-        print(f"Card: {c.get('name', '[nameがありません]')}")
-        # emailキーが存在しない場合は必ず新規カードとして扱う
-        if "email" not in c or c["email"] is None:
-            # emailがない場合は重複チェック不可能なので、新規として扱う
-            new_.append(c)
-        else:
-            # emailがあれば重複チェック
-            (dup_ if exists(c["email"]) else new_).append(c)
+        c = dict(c)
+        if c.get("email") is not None:
+            c["email"] = normalize_email(c["email"])
+        cards.append(c)
+    existing = existing_emails(c["email"] for c in cards if c.get("email"))
+
+    new_, dup_ = [], []
+    for c in cards:
+        logger.debug("Card: %s", c.get("name", "[nameがありません]"))
+        # emailがない場合はここでは新規とし、後段のあいまい照合に回す
+        (dup_ if c.get("email") in existing else new_).append(c)
+
+    # メールアドレスで一致しなかったカード (メール無し・誤読を含む) はあいまい照合する
+    matches = find_fuzzy_duplicates(new_)
+    if matches:
+        for i, match in matches.items():
+            new_[i]["duplicate_of"] = match
+        dup_ += [c for i, c in enumerate(new_) if i in matches]
+        new_ = [c for i, c in enumerate(new_) if i not in matches]
+    for i, c in enumerate(dup_):
+        c["dup_key"] = f"{i}:{c.get('email') or 'id:%d' % c['duplicate_of']['id']}"
+    state["cards"] = cards
     state["new_cards"], state["dup_cards"] = new_, dup_
-    state["need_human"] = bool(dup_) and not state.get("decisions")
+    state["need_human"] = bool(dup_) and not state.get("decisions") and not state.get("default_decision")
     return state
 
 def gate(state: State) -> State:
-    # 重複ありかつ decisions 未確定 → 一時停止
+    # 重複ありかつ decisions 未確定 → 一時停止し、再開時に渡された decisions で apply へ進む
     if state["need_human"]:
-        interrupt(state)
+        state["decisions"] = interrupt({"dup_cards": state["dup_cards"]})
+        state["need_human"] = False
     return state
 
+@timed("graph.apply_decision")
 def apply_decision(state: State) -> State:
-    # 重複カードには必ずemailがあるはずだが、安全のためチェック
-    overwrite = {}
+    decisions = state.get("decisions", {})
+    overwrite, updates, skip = [], [], []
     for c in state.get("dup_cards", []):
-        if "email" in c and c["email"] and state["decisions"].get(c["email"]) == "overwrite":
-            overwrite[c["email"]] = c
-    
-    # skip処理も安全に行う
-    skip = set()
-    for email in state.get("decisions", {}):
-        if email and state["decisions"].get(email) == "skip":
-            skip.add(email)
+        key = dup_key(c)
+        # 個別の決定が無い場合は default_decision (CLIの一括取り込みなど) に従う
+        decision = decisions.get(key, state.get("default_decision"))
+        if decision == "overwrite":
+            # あいまい一致の上書きは、一致した既存連絡先の id をキーにその行を更新する
+            # (読み取った・手で直したメールアドレスはそのまま保存する)
+            (updates if "duplicate_of" in c else overwrite).append(c)
+        elif decision == "skip":
+            skip.append(key)
     
     # 最終的な保存カードを用意
-    state["final_cards"] = state.get("new_cards", []) + list(overwrite.values())
-    state["skipped"] = list(skip)
+    state["final_cards"] = state.get("new_cards", []) + overwrite
+    state["final_updates"] = updates
+    state["skipped"] = skip
     return state
 
+@timed("graph.save_node")
 def save_node(state: State) -> State:
-    save_cards(state["final_cards"])
+    updates = {c["duplicate_of"]["id"]: c for c in state.get("final_updates", [])}
+    state["saved"] = save_cards(state["final_cards"], updates)
     return state
 
-def create_graph():
+def open_checkpointer(path: str | None = None):
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    # Streamlitはスクリプトを別スレッドで実行するので、スレッドをまたいで接続を使う (SqliteSaver側でロックする)
+    saver = SqliteSaver(sqlite3.connect(path or CHECKPOINT_PATH, check_same_thread=False))
+    saver.setup()
+    with saver.lock, saver.conn as con:
+        # 一時停止中のバッチの一覧 (チェックポイントを1件ずつ読まずに一覧・期限切れの判定をするため)
+        # owner: バッチを開始したセッション。一覧はそのセッションにだけ表示する
+        created = con.execute("SELECT 1 FROM sqlite_master WHERE name='paused_batches'").fetchone() is None
+        con.execute("""CREATE TABLE IF NOT EXISTS paused_batches (
+                           batch_id  TEXT PRIMARY KEY,
+                           owner     TEXT,
+                           paused_at REAL NOT NULL)""")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_paused_batches_owner ON paused_batches(owner, paused_at)")
+        if created:
+            # 以前の版で一時停止したバッチは、URLのバッチIDからは再開でき、期限が来たら削除されるようにする
+            con.execute("INSERT OR IGNORE INTO paused_batches SELECT DISTINCT thread_id, NULL, ? FROM checkpoints",
+                        (time.time(),))
+    return saver
+
+def create_graph(checkpointer=None):
     sg = StateGraph(State)
     sg.add_node("check", check_dup)
     sg.add_node("gate", gate)
@@ -57,12 +123,67 @@ def create_graph():
 
     sg.set_entry_point("check")
     sg.add_edge("check", "gate")
-    sg.add_conditional_edges(
-        "gate",
-        lambda s: "apply" if not s["need_human"] else "END",
-    )
+    sg.add_edge("gate", "apply")
     sg.add_edge("apply", "save")
     sg.set_finish_point("save")
 
-    # checkpointerが問題を起こしているので完全に無効化
-    return sg.compile()
+    # 一時停止 (interrupt) するには checkpointer が必要。CLIのように事前に決定を渡す場合は不要
+    return sg.compile(checkpointer=checkpointer)
+
+def _config(batch_id: str) -> dict:
+    return {"configurable": {"thread_id": batch_id}}
+
+def _delete_batch(saver, batch_id: str):
+    saver.delete_thread(batch_id)
+    with saver.lock, saver.conn as con:
+        con.execute("DELETE FROM paused_batches WHERE batch_id = ?", (batch_id,))
+
+def _finish(graph, batch_id: str, owner: str | None = None) -> Tuple[State, bool]:
+    snapshot = graph.get_state(_config(batch_id))
+    if snapshot.next:
+        with graph.checkpointer.lock, graph.checkpointer.conn as con:
+            con.execute("INSERT OR IGNORE INTO paused_batches VALUES (?, ?, ?)", (batch_id, owner, time.time()))
+        return snapshot.values, True
+    # 保存まで終わったバッチはチェックポイントを残さない (一時停止中のバッチだけが残る)
+    _delete_batch(graph.checkpointer, batch_id)
+    return snapshot.values, False
+
+def start_batch(graph, cards: List[Card], owner: str | None = None) -> Tuple[str, State, bool]:
+    # バッチIDをキーにグラフを実行する。(バッチID, ステート, 重複確認待ちか) を返す
+    # owner: 一時停止した場合に paused_batches で一覧に出すセッション
+    batch_id = uuid.uuid4().hex
+    graph.invoke({"cards": cards}, _config(batch_id))
+    state, paused = _finish(graph, batch_id, owner)
+    return batch_id, state, paused
+
+def resume_batch(graph, batch_id: str, decisions: dict) -> State:
+    # 重複確認の決定を渡し、保存済みのチェックポイントから apply 以降だけを実行する
+    graph.invoke(Command(resume=decisions), _config(batch_id))
+    state, _ = _finish(graph, batch_id)
+    return state
+
+def get_batch(graph, batch_id: str) -> State | None:
+    # 重複確認待ちのバッチのステート (無い・完了済みなら None)
+    snapshot = graph.get_state(_config(batch_id))
+    return snapshot.values if snapshot.next else None
+
+def expire_batches(graph, ttl: float | None = None) -> int:
+    # 一時停止から ttl 秒以上経ったバッチを削除し、削除した数を返す
+    saver = graph.checkpointer
+    cutoff = time.time() - (GRAPH_BATCH_TTL_SEC if ttl is None else ttl)
+    with saver.lock:
+        expired = [r[0] for r in saver.conn.execute("SELECT batch_id FROM paused_batches WHERE paused_at < ?",
+                                                    (cutoff,))]
+    for batch_id in expired:
+        _delete_batch(saver, batch_id)
+    if expired:
+        logger.info("期限切れの重複確認待ちバッチを %d 件削除しました", len(expired))
+    return len(expired)
+
+def paused_batches(graph, owner: str) -> List[str]:
+    # owner のセッションが開始した、重複確認待ちのバッチID (新しい順)
+    expire_batches(graph)
+    with graph.checkpointer.lock:
+        rows = graph.checkpointer.conn.execute(
+            "SELECT batch_id FROM paused_batches WHERE owner = ? ORDER BY paused_at DESC", (owner,)).fetchall()
+    return [r[0] for r in rows]
@@ -0,0 +1,310 @@
+# jobs.py
+# OCRジョブのキュー (SQLite)
+# UIは画像をジョブとして登録して進捗を読むだけで、OCRは別プロセスのワーカー (python cli.py worker) が行う
+# ワーカーはジョブを順番に少しずつ取り出すので、大きなバッチがあっても他のユーザーのジョブが待たされ続けない
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional
+from models import Card
+from ocr import OCR_BATCH_SIZE, OCR_MAX_WORKERS, empty_card, get_backends, iter_ocr
+import metrics
+import ocr
+import spool
+
+logger = logging.getLogger(__name__)
+
+JOBS_PATH = os.environ.get("OCR_JOBS_PATH", "jobs.db")
+# 取り出したまま完了しないタスク (ワーカーの異常終了など) をこの秒数で再度キューに戻す
+JOB_LEASE_SEC = float(os.environ.get("OCR_JOB_LEASE_SEC", "300"))
+# APIの障害など一時的なエラーになったタスクは、画像を残したままキューに戻して再試行する
+# 試行回数がこの値に達したら failed にする。再試行までの待ち時間は OCR_JOB_RETRY_BASE 秒から倍々に延ばす
+JOB_MAX_ATTEMPTS = int(os.environ.get("OCR_JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE = float(os.environ.get("OCR_JOB_RETRY_BASE", "10"))
+JOB_RETRY_MAX = 600
+# 完了してからこの秒数が過ぎたジョブは、結果ごとキューのDBから削除する (再読み込みで解析結果を引き継げるのはこの間)
+JOB_TTL_SEC = float(os.environ.get("OCR_JOB_TTL_SEC", "604800"))
+# ワーカーが期限切れのジョブを削除する間隔 (秒)
+PURGE_INTERVAL = 3600
+# 再試行するエラー (request_failed: 再試行を使い切ったAPIエラー・サーキットブレーカーによる停止)
+RETRYABLE_ERRORS = ("request_failed",)
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+
+class QueuedImage:
+    # st.file_uploader の UploadedFile と同じインターフェース (name / getvalue)
+    # 画像はキューのDBに置いたまま、必要になった時点で読む (取り出したタスクの画像をまとめてメモリに載せない)
+    def __init__(self, task_id: int, name: str, size: int, path: str | None = None):
+        self.task_id = task_id
+        self.name = name
+        self.size = size
+        self.path = path
+
+    def iter_chunks(self, chunk_size: int = spool.CHUNK_SIZE):
+        con = _connect(self.path)
+        try:
+            with con.blobopen("ocr_tasks", "image", self.task_id, readonly=True) as blob:
+                while True:
+                    chunk = blob.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            con.close()
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+
+def _connect(path: str | None = None) -> sqlite3.Connection:
+    con = sqlite3.connect(path or JOBS_PATH, timeout=30)
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+
+def init_jobs(path: str | None = None):
+    with _connect(path) as con:
+        # UIとワーカーが同時に読み書きするのでWALにする
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_jobs (
+                id              TEXT PRIMARY KEY,
+                total           INTEGER NOT NULL,
+                created_at      REAL NOT NULL,
+                last_claimed_at REAL NOT NULL DEFAULT 0,
+                finished_at     REAL
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_tasks (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id      TEXT NOT NULL,
+                idx         INTEGER NOT NULL,
+                name        TEXT,
+                image       BLOB,           -- done / failed になったら削除する
+                status      TEXT NOT NULL,  -- queued / running / done / failed
+                card        TEXT,
+                worker      TEXT,
+                claimed_at  REAL,
+                finished_at REAL,
+                attempts    INTEGER NOT NULL DEFAULT 0,
+                not_before  REAL NOT NULL DEFAULT 0   -- 再試行を待つタスクはこの時刻まで取り出さない
+            );
+        """)
+        columns = {r[1] for r in con.execute("PRAGMA table_info(ocr_tasks)")}
+        for column in ("attempts INTEGER NOT NULL DEFAULT 0", "not_before REAL NOT NULL DEFAULT 0"):
+            if column.split()[0] not in columns:
+                con.execute(f"ALTER TABLE ocr_tasks ADD COLUMN {column}")
+        con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ocr_tasks_job ON ocr_tasks(job_id, idx)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ocr_tasks_queued ON ocr_tasks(job_id, idx) WHERE status = 'queued'")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ocr_tasks_running ON ocr_tasks(claimed_at) WHERE status = 'running'")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ocr_jobs_open ON ocr_jobs(last_claimed_at) WHERE finished_at IS NULL")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_ocr_jobs_finished ON ocr_jobs(finished_at) WHERE finished_at IS NOT NULL")
+    purge(path=path, force=True)
+
+
+def purge(ttl: float | None = None, path: str | None = None, force: bool = False) -> int:
+    # 完了から ttl 秒以上経ったジョブをタスク (結果のカード) ごと削除し、削除したジョブの数を返す
+    # ワーカーのループから呼んでも PURGE_INTERVAL に1回だけ削除する
+    global _last_purge
+    with _purge_lock:
+        now = time.time()
+        if not force and now - _last_purge < PURGE_INTERVAL:
+            return 0
+        _last_purge = now
+    cutoff = now - (JOB_TTL_SEC if ttl is None else ttl)
+    with _connect(path) as con:
+        con.execute("BEGIN IMMEDIATE")
+        expired = [r[0] for r in con.execute("SELECT id FROM ocr_jobs WHERE finished_at < ?", (cutoff,))]
+        con.executemany("DELETE FROM ocr_tasks WHERE job_id = ?", [(j,) for j in expired])
+        con.executemany("DELETE FROM ocr_jobs WHERE id = ?", [(j,) for j in expired])
+    if expired:
+        logger.info("期限切れのOCRジョブを %d 件削除しました", len(expired))
+    return len(expired)
+
+
+def enqueue(files, path: str | None = None) -> str:
+    # 画像をジョブとして登録し、ジョブIDを返す
+    # 画像は領域を確保してから少しずつ書き込むので、大きな画像・多数の画像でもメモリに全体を載せない
+    files = list(files)
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _connect(path) as con:
+        con.execute("INSERT INTO ocr_jobs (id, total, created_at) VALUES (?,?,?)", (job_id, len(files), now))
+        for i, f in enumerate(files):
+            cur = con.execute("""INSERT INTO ocr_tasks (job_id, idx, name, image, status)
+                                 VALUES (?,?,?, zeroblob(?), 'queued')""", (job_id, i, f.name, spool.size_of(f)))
+            with con.blobopen("ocr_tasks", "image", cur.lastrowid) as blob:
+                for chunk in spool.iter_chunks(f):
+                    blob.write(chunk)
+    return job_id
+
+
+def job_status(job_id: str, path: str | None = None) -> Optional[Dict[str, int]]:
+    # {"total", "queued", "running", "done", "failed"} (ジョブが無ければ None)
+    with _connect(path) as con:
+        row = con.execute("SELECT total FROM ocr_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        status = {"total": row[0], "queued": 0, "running": 0, "done": 0, "failed": 0}
+        for name, count in con.execute("SELECT status, COUNT(*) FROM ocr_tasks WHERE job_id = ? GROUP BY status",
+                                       (job_id,)):
+            status[name] = count
+    return status
+
+
+def job_results(job_id: str, path: str | None = None) -> List[Card | None]:
+    # 入力順のカード (未完了の画像は None)
+    with _connect(path) as con:
+        rows = con.execute("SELECT idx, card FROM ocr_tasks WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+    return [json.loads(card) if card is not None else None for _, card in rows]
+
+
+def claim(worker: str, limit: int, path: str | None = None) -> List[dict]:
+    # 最後に取り出されてから最も時間が経ったジョブから、最大 limit 枚を取り出す (ジョブ間のラウンドロビン)
+    now = time.time()
+    with _connect(path) as con:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("UPDATE ocr_tasks SET status = 'queued', worker = NULL WHERE status = 'running' AND claimed_at < ?",
+                    (now - JOB_LEASE_SEC,))
+        row = con.execute("""
+            SELECT j.id FROM ocr_jobs j
+            WHERE j.finished_at IS NULL
+              AND EXISTS (SELECT 1 FROM ocr_tasks t WHERE t.job_id = j.id AND t.status = 'queued' AND t.not_before <= ?)
+            ORDER BY j.last_claimed_at, j.created_at
+            LIMIT 1
+        """, (now,)).fetchone()
+        if row is None:
+            return []
+        job_id = row[0]
+        ids = [r[0] for r in con.execute(
+            "SELECT id FROM ocr_tasks WHERE job_id = ? AND status = 'queued' AND not_before <= ? ORDER BY idx LIMIT ?",
+            (job_id, now, limit))]
+        con.executemany("UPDATE ocr_tasks SET status = 'running', worker = ?, claimed_at = ? WHERE id = ?",
+                        [(worker, now, i) for i in ids])
+        con.execute("UPDATE ocr_jobs SET last_claimed_at = ? WHERE id = ?", (now, job_id))
+        rows = con.execute(f"SELECT id, job_id, idx, name, length(image) FROM ocr_tasks"
+                           f" WHERE id IN ({','.join('?' * len(ids))}) ORDER BY idx", ids).fetchall()
+    # 画像そのものは読まない (QueuedImage が必要な時に読む)
+    return [{"id": r[0], "job_id": r[1], "idx": r[2], "name": r[3], "size": r[4]} for r in rows]
+
+
+def retry_later(task: dict, error: str, path: str | None = None) -> bool:
+    # 画像を残したままタスクをキューに戻し、少し待ってから再試行させる
+    # 試行回数の上限に達した場合は何もせず False (呼び出し側で failed にする)
+    now = time.time()
+    with _connect(path) as con:
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute("SELECT attempts FROM ocr_tasks WHERE id = ? AND status = 'running'", (task["id"],)).fetchone()
+        if row is None:
+            # リースが切れて他のワーカーが取り出した (または完了させた) タスク
+            return True
+        attempts = row[0] + 1
+        if attempts >= JOB_MAX_ATTEMPTS:
+            con.execute("UPDATE ocr_tasks SET attempts = ? WHERE id = ?", (attempts, task["id"]))
+            return False
+        # サーキットブレーカーが開いている間は、閉じるまで取り出さない
+        delay = max(min(JOB_RETRY_MAX, JOB_RETRY_BASE * 2 ** (attempts - 1)), ocr.scheduler.breaker.remaining())
+        con.execute("""UPDATE ocr_tasks SET status = 'queued', worker = NULL, attempts = ?, not_before = ?
+                       WHERE id = ?""", (attempts, now + delay, task["id"]))
+    metrics.record("jobs.retry", delay * 1000, attempt=attempts, error=error)
+    logger.info("タスク %s を %.0f 秒後に再試行します (%s, %d 回目)", task["id"], delay, error, attempts)
+    return True
+
+
+def complete(task: dict, card: Card, path: str | None = None):
+    if card.get("error") in RETRYABLE_ERRORS and retry_later(task, card["error"], path):
+        return
+    now = time.time()
+    status = "failed" if "error" in card else "done"
+    with _connect(path) as con:
+        # 完了したタスクの画像は削除する (一時的なエラーは retry_later が画像を残して再試行済み)
+        con.execute("""UPDATE ocr_tasks SET status = ?, card = ?, finished_at = ?, image = NULL
+                       WHERE id = ? AND status != 'done'""",
+                    (status, json.dumps(card, ensure_ascii=False), now, task["id"]))
+        con.execute("""UPDATE ocr_jobs SET finished_at = ? WHERE id = ? AND NOT EXISTS
+                           (SELECT 1 FROM ocr_tasks WHERE job_id = ? AND status IN ('queued', 'running'))""",
+                    (now, task["job_id"], task["job_id"]))
+
+
+def release(worker: str, path: str | None = None):
+    # ワーカーの停止時に、処理中のタスクをキューに戻す
+    with _connect(path) as con:
+        con.execute("UPDATE ocr_tasks SET status = 'queued', worker = NULL WHERE status = 'running' AND worker = ?",
+                    (worker,))
+
+
+def _give_back(tasks: List[dict], error: str, path: str | None = None):
+    # 処理の途中で失敗したタスクを再試行に回す (試行回数を使い切ったものは failed にする)
+    for task in tasks:
+        if not retry_later(task, error, path):
+            complete(task, empty_card(error), path)
+
+
+def _loop(worker: str, batch_size: int, claim_size: int, poll_interval: float, client, backends, stop, path):
+    try:
+        while not stop.is_set():
+            # サーキットブレーカーが開いている間は取り出さない (取り出しても失敗して再試行を待つだけになる)
+            pause = ocr.scheduler.breaker.remaining()
+            if pause > 0:
+                stop.wait(pause)
+                continue
+            tasks = []
+            try:
+                purge(path=path)
+                tasks = claim(worker, claim_size, path)
+                if not tasks:
+                    time.sleep(poll_interval)
+                    continue
+                files = [QueuedImage(t["id"], t["name"], t["size"], path) for t in tasks]
+                # OCR_SIMILAR_REUSE で再利用したカードは、UIの編集フォームで確認してから保存される
+                for i, card in iter_ocr(files, max_workers=1, client=client, batch_size=batch_size, backends=backends):
+                    complete(tasks[i], card, path)
+                logger.debug("%s: %d 枚完了 (最大メモリ使用量 %s MB)", worker, len(tasks), metrics.peak_rss_mb())
+            except Exception as e:
+                # DBのロック待ちの時間切れなどでスレッドを止めない。取り出したタスクを戻して続ける
+                logger.exception("%s: OCRジョブの処理中にエラー", worker)
+                metrics.record("jobs.error", error=type(e).__name__)
+                try:
+                    _give_back(tasks, "worker_error", path)
+                except Exception:
+                    logger.exception("%s: タスクをキューに戻せませんでした (リース切れ後に再処理されます)", worker)
+                stop.wait(poll_interval)
+    finally:
+        release(worker, path)
+
+
+def work(max_workers: int | None = None, batch_size: int | None = None, claim_size: int | None = None,
+         poll_interval: float = 0.5, client=None, stop: threading.Event | None = None, path: str | None = None):
+    # キューからタスクを取り出してOCRし、結果を書き戻す (stop がセットされるまで続ける)
+    # max_workers 本のスレッドがそれぞれ1リクエスト分ずつ取り出すので、遅いリクエストが他を待たせない
+    init_jobs(path)
+    # OCR_BACKENDS の設定誤りはスレッドを起動する前にエラーにする
+    backends = get_backends(client)
+    stop = stop or threading.Event()
+    batch_size = max(1, batch_size or OCR_BATCH_SIZE)
+    claim_size = claim_size or batch_size
+    threads = []
+    for n in range(max_workers or OCR_MAX_WORKERS):
+        worker = f"{socket.gethostname()}:{os.getpid()}:{n}"
+        args = (worker, batch_size, claim_size, poll_interval, client, backends, stop, path)
+        threads.append(threading.Thread(target=_loop, daemon=True, args=args))
+    logger.info("OCRワーカー開始: %s (%d スレッド)", socket.gethostname(), len(threads))
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        # 処理中のリクエストが終わるのを待ち、取り出し済みのタスクをキューに戻してから終了する
+        stop.set()
+        for t in threads:
+            t.join()
+        raise
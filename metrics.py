@@ -0,0 +1,212 @@
+# metrics.py
+# ステージごとの計測 (所要時間・トークン数・送信バイト数など) を集計し、差し替え可能な出力先へ送る
+#   METRICS_SINKS=logging,jsonl,prometheus
+#   METRICS_JSONL_PATH=metrics.jsonl  METRICS_PROM_HOST=127.0.0.1  METRICS_PROM_PORT=9464
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Windows では最大メモリ使用量を取得しない
+    resource = None
+
+logger = logging.getLogger("bizcard.metrics")
+
+# 所要時間の分位点を計算するために保持する直近の件数 (イベントごと)
+WINDOW = 1000
+
+# 名前の後ろに可変の部分を持つイベント (接頭辞 → Prometheus のラベル名)
+# 例: "ocr.backend.openai:gpt-4o" → bizcard_ocr_backend_count{backend="openai:gpt-4o"}
+LABELED_EVENTS = {"ocr.backend.": "backend"}
+
+
+class LoggingSink:
+    def emit(self, event: dict):
+        logger.info(json.dumps(event, ensure_ascii=False))
+
+
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as fp:
+            fp.write(line + "\n")
+
+
+class PrometheusSink:
+    # 集計値を Prometheus のテキスト形式で返す HTTP エンドポイントを立てる (個別イベントは送らない)
+    # 認証の無いエンドポイントなので、既定ではローカルからの取得だけを受け付ける
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.port = port
+        self.server = ThreadingHTTPServer((host, port), _PrometheusHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def emit(self, event: dict):
+        pass
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_sinks: List[object] = []
+_stats: Dict[str, dict] = {}
+_lock = threading.Lock()
+
+
+def configure(names: str | None = None):
+    # 出力先を設定し直す (カンマ区切り: logging / jsonl / prometheus)
+    # 既定ではイベントごとの出力はしない (集計値は stats() / 統計パネルで見られる)
+    global _sinks
+    names = os.environ.get("METRICS_SINKS", "") if names is None else names
+    sinks = []
+    for name in filter(None, (n.strip() for n in names.split(","))):
+        if name == "logging":
+            sinks.append(LoggingSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink(os.environ.get("METRICS_JSONL_PATH", "metrics.jsonl")))
+        elif name == "prometheus":
+            sinks.append(PrometheusSink(int(os.environ.get("METRICS_PROM_PORT", "9464")),
+                                        os.environ.get("METRICS_PROM_HOST", "127.0.0.1")))
+        else:
+            raise ValueError(f"unknown metrics sink: {name}")
+    _sinks = sinks
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def record(name: str, duration_ms: float | None = None, **fields):
+    event = {"ts": time.time(), "event": name}
+    if duration_ms is not None:
+        event["duration_ms"] = round(duration_ms, 3)
+    event.update(fields)
+
+    with _lock:
+        stat = _stats.setdefault(name, {"count": 0, "durations": deque(maxlen=WINDOW), "sums": {}})
+        stat["count"] += 1
+        if duration_ms is not None:
+            stat["durations"].append(duration_ms)
+        for key, value in fields.items():
+            # 数値のフィールド (トークン数・バイト数など) は合計を取る。真偽値は件数として数える
+            if isinstance(value, (int, float)):
+                stat["sums"][key] = stat["sums"].get(key, 0) + value
+
+    for sink in list(_sinks):
+        try:
+            sink.emit(event)
+        except Exception:
+            logger.exception("metrics sink failed")
+
+
+@contextmanager
+def timer(name: str, **fields):
+    # with timer("stage") as m: ... m["cards"] = 10 のように途中でフィールドを追加できる
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record(name, (time.perf_counter() - started) * 1000, **fields)
+
+
+def timed(name: str):
+    # グラフのノードなど、関数全体の所要時間を計測するデコレーター
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _percentile(values, p: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def snapshot() -> Dict[str, dict]:
+    # イベントごとの件数・所要時間の分位点・数値フィールドの合計
+    with _lock:
+        return {
+            name: {
+                "count": stat["count"],
+                "p50_ms": round(_percentile(stat["durations"], 50), 3),
+                "p99_ms": round(_percentile(stat["durations"], 99), 3),
+                **{f"{k}_total": v for k, v in stat["sums"].items()},
+            }
+            for name, stat in _stats.items()
+        }
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def peak_rss_mb() -> float | None:
+    # このプロセスの最大常駐メモリ (MB)。取得できない環境では None
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _metric_name(name: str) -> str:
+    # Prometheus のメトリクス名に使えない文字 ([a-zA-Z0-9_] 以外) は _ に置き換える
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus() -> str:
+    lines = []
+    peak_rss = peak_rss_mb()
+    if peak_rss is not None:
+        lines.append(f"bizcard_process_peak_rss_mb {peak_rss:.1f}")
+    # 同じメトリクスの行 (ラベル違い) は続けて出力する
+    families: Dict[str, List[str]] = {}
+    for name, stat in snapshot().items():
+        labels = ""
+        for prefix, label in LABELED_EVENTS.items():
+            if name.startswith(prefix):
+                name, labels = prefix.rstrip("."), f'{{{label}="{_label_value(name[len(prefix):])}"}}'
+                break
+        base = "bizcard_" + _metric_name(name)
+        for key, value in stat.items():
+            metric = f"{base}_count" if key == "count" else f"{base}_{_metric_name(key)}"
+            families.setdefault(metric, []).append(f"{metric}{labels} {value}")
+    for family in families.values():
+        lines.extend(family)
+    return "\n".join(lines) + "\n"
+
+
+configure()
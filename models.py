@@ -1,6 +1,21 @@
 # models.py
 from typing import List, Dict, TypedDict, Literal
 
+class DuplicateMatch(TypedDict):
+    id: int                   # 既存連絡先の id
+    email: str | None         # 既存連絡先のメールアドレス
+    name: str | None
+    company: str | None
+    score: float              # 類似度 (0〜1)
+    reason: str               # 一致したブロッキングキー
+
+class SimilarImage(TypedDict, total=False):
+    key: str                  # 解析結果を再利用した画像のキャッシュキー
+    distance: int             # 知覚ハッシュ (dHash) のハミング距離 (0〜64)
+    source: str               # "batch" (同じバッチ内の画像) / "history" (過去に解析した画像)
+    name: str                 # 同じバッチ内の画像のファイル名 (source="batch" のみ)
+    reused: bool              # True: APIに送らずその解析結果を再利用した / False: 印を付けただけ
+
 class Card(TypedDict, total=False):
     name: str | None
     company: str | None
@@ -13,12 +28,24 @@ class Card(TypedDict, total=False):
     company_url: str | None   # 会社URL
     company_phone: str | None # 会社電話
     company_fax: str | None   # 会社FAX
+    duplicate_of: DuplicateMatch  # あいまい重複検出で見つかった既存連絡先
+    similar_to: SimilarImage  # ほぼ同じ画像と判定した場合の元画像
+    dup_key: str              # 重複カードの決定のキー (dup_cards 内の位置 + メールアドレス/既存連絡先の id)
 
 class State(TypedDict, total=False):
     cards: List[Card]                                    # OCR 済みすべて
     new_cards: List[Card]                                # 既存無し
     dup_cards: List[Card]                                # 衝突分
     need_human: bool                                     # True → UI 介入
-    decisions: Dict[str, Literal["overwrite", "skip"]]   # email → 行動
-    final_cards: List[Card]                              # 保存対象
-    skipped: List[str]                                   # スキップ email
+    decisions: Dict[str, Literal["overwrite", "skip"]]   # dup_key (email 等) → 行動
+    default_decision: Literal["overwrite", "skip"]       # 個別の決定が無い重複カードの行動
+    final_cards: List[Card]                              # 保存対象 (メールアドレスでupsert)
+    final_updates: List[Card]                            # あいまい一致の上書き (duplicate_of の id の行を更新)
+    skipped: List[str]                                   # スキップ dup_key
+    saved: Dict[str, int]                                # 保存結果 (inserted / updated 件数)
+
+class PreparedImage(TypedDict):
+    data: bytes          # API に送る画像バイト列
+    mime_type: str       # 実データから判定した MIME タイプ
+    bytes_before: int    # 前処理前のサイズ
+    bytes_after: int     # 前処理後のサイズ
@@ -1,24 +1,47 @@
 # ocr.py
+import os
 import json
 import base64
-from typing import List
+import hashlib
+import logging
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, List, Tuple
 from openai import OpenAI
 from models import Card
+from backends import Backend, StubBackend, TesseractBackend, chain_name, run_chain
+from preprocess import prepare_image
+import cache
+import metrics
+import preprocess
+import spool
+from ratelimit import Scheduler
 
-client = OpenAI()
-
-def ocr_many(files) -> List[Card]:
-    out: List[Card] = []
-    for f in files:
-        # ファイル名から適切なMIMEタイプを自動判定
-        filename = f.name.lower() if hasattr(f, "name") else "unknown"
-        mime_type = "image/jpeg" if filename.endswith((".jpg", ".jpeg")) else "image/png"
-        
-        # 正しいMIMEタイプでdata URIを生成
-        data_uri = f"data:{mime_type};base64," + base64.b64encode(f.getvalue()).decode()
-        
-        # より詳細なプロンプトを使用
-        system_prompt = """
+logger = logging.getLogger(__name__)
+
+# 同時にAPIへ投げるリクエスト数の上限
+OCR_MAX_WORKERS = int(os.environ.get("OCR_MAX_WORKERS", "8"))
+
+MODEL = os.environ.get("OCR_MODEL", "gpt-4o")
+
+# 前から順に試すOCRバックエンド (カンマ区切り: openai / tesseract / stub)
+# 例: tesseract,openai → ローカルOCRで主要フィールドが揃わなかった名刺だけをVisionモデルに送る
+OCR_BACKENDS = os.environ.get("OCR_BACKENDS", "openai")
+
+# 画像の解析精度 ("low" / "high" / "auto" / "adaptive")
+# adaptive: まず low で送り、主要フィールドが取れなかった場合だけ high で再解析する
+OCR_DETAIL = os.environ.get("OCR_DETAIL", "adaptive")
+KEY_FIELDS = ["name", "email"]
+
+# 1リクエストにまとめる名刺の枚数 (1 ならまとめない)
+OCR_BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE", "1"))
+
+REQUIRED_FIELDS = ["name", "company", "email", "phone", "department", "job_title", "qualification", "company_address", "company_url", "company_phone", "company_fax"]
+
+# より詳細なプロンプトを使用
+SYSTEM_PROMPT = """
         あなたは名刺画像のテキストを正確に抽出するOCRエンジンです。
         以下のフィールドを含むJSON形式でのみ回答してください：
 
@@ -35,51 +58,403 @@ def ocr_many(files) -> List[Card]:
           "company_phone": "会社電話", // 会社電話。存在しない場合はnull
           "company_fax": "会社FAX" // 会社FAX。存在しない場合はnull
         }}
-        
+
         注意: 必ず有効なJSON形式で全フィールドを含めてください。存在しないフィールドはnullとしてください。
         画像に文字が見つからない場合でも、空のJSONを返さず必ず全フィールドに値を設定してください。
         """
-        
-        # より性能の高いモデルを使用
-        resp = client.chat.completions.create(
-            model="gpt-4o",  # より性能の高いモデルに変更
-            temperature=0,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "image_url", "image_url": {"url": data_uri}}
-                ]},
-            ],
-        )
-        
-        # デバッグ用に生のAPIレスポンスを表示
-        raw_content = resp.choices[0].message.content
-        print(f"OCR結果: {raw_content}")
-        
-        # Markdownコードブロック文法を削除
-        content_to_parse = raw_content
-        # ```jsonと```を削除
-        if content_to_parse.startswith('```'):
-            # 最初の```行を削除
-            first_newline = content_to_parse.find('\n')
-            if first_newline != -1:
-                content_to_parse = content_to_parse[first_newline+1:]
-            # 最後の```を削除
-            last_backticks = content_to_parse.rfind('```')
-            if last_backticks != -1:
-                content_to_parse = content_to_parse[:last_backticks]
-        
-        print(f"パース対象: {content_to_parse}")
-        
+
+# 複数枚をまとめて送る場合のプロンプト
+BATCH_PROMPT = SYSTEM_PROMPT + """
+        今回は複数の名刺画像が順番に与えられます。
+        画像1枚につき上記のJSONオブジェクトを1つ作成し、画像と同じ順番で並べたJSON配列のみを回答してください。
+        配列の要素数は必ず画像の枚数と一致させてください。
+        """
+
+# 知覚ハッシュ (dHash, 64ビット) のハミング距離がこの値以下の画像は同じ名刺の可能性があるとして、
+# 過去または同じバッチ内で解析した画像をカードの similar_to に記録する (-1 で無効、過去の画像を索引で探せるのは3まで)
+# 名刺全体のハッシュなので、氏名だけが違う同じ会社の名刺とも近くなる。大きくしすぎないこと
+OCR_SIMILAR_DISTANCE = int(os.environ.get("OCR_SIMILAR_DISTANCE", "2"))
+# 1 にすると、ほぼ同じ画像はAPIに送らずに解析済みの結果を再利用する (既定は印を付けるだけ)
+# 別人の名刺を取り違えても気付けるよう、結果を確認する画面がある経路 (UIのOCRジョブ) でのみ有効にすること
+OCR_SIMILAR_REUSE = os.environ.get("OCR_SIMILAR_REUSE", "0") == "1"
+
+# 解析中の画像に使うメモリの上限 (MB)。プロセス内の全ての iter_ocr (ワーカーの各スレッドを含む) で共有する
+# 上限に達したら、先のリクエストが終わるまで次の画像を読み込まない
+# 画像1枚あたり元の画像 + 前処理後の画像 + base64 (約1.33倍) + リクエスト本文 が同時に載るので、元のサイズの約4倍で見積もる
+OCR_MEMORY_LIMIT_MB = float(os.environ.get("OCR_MEMORY_LIMIT_MB", "256"))
+IMAGE_MEMORY_FACTOR = 4
+
+# JSONとして読めない応答だった場合に同じ画像を再リクエストする回数
+OCR_PARSE_RETRIES = int(os.environ.get("OCR_PARSE_RETRIES", "1"))
+
+# プロンプトを変更するとキャッシュキーも変わるよう、内容から版を決める
+PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode()).hexdigest()[:12]
+
+client = None
+# レート制限・再試行・サーキットブレーカーはプロセス内の全リクエストで共有する
+scheduler = Scheduler()
+
+
+class MemoryBudget:
+    # 解析中の画像の見積もりメモリ (バイト) をプロセス全体で数える
+    # 上限は OCR_MEMORY_LIMIT_MB を都度読む (ベンチマークなどで変更できるように)
+    def __init__(self):
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, need: int, block: bool) -> bool:
+        # 上限内に収まれば確保する。block=True なら収まるまで待つ
+        # どこも使っていなければ、上限を超える大きな画像でも1リクエストずつは進める
+        limit = OCR_MEMORY_LIMIT_MB * 2 ** 20
+        with self._cond:
+            fits = lambda: self.in_use == 0 or self.in_use + need <= limit
+            if not fits():
+                metrics.record("ocr.memory_wait", in_use=self.in_use, need=need)
+                if not block:
+                    return False
+                self._cond.wait_for(fits)
+            self.in_use += need
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, need: int):
+        with self._cond:
+            self.in_use -= need
+            self._cond.notify_all()
+
+
+memory_budget = MemoryBudget()
+
+def get_client():
+    # APIキー未設定でもimportできるよう、クライアントは初回利用時に生成する
+    # 再試行は scheduler が行うので、SDK側の再試行は無効にする
+    global client
+    if client is None:
+        client = OpenAI(max_retries=0)
+    return client
+
+def empty_card(error: str) -> Card:
+    card = {field: None for field in REQUIRED_FIELDS}
+    card["error"] = error
+    return card
+
+def strip_code_fence(raw_content: str) -> str:
+    # Markdownコードブロック文法を削除
+    content_to_parse = raw_content
+    # ```jsonと```を削除
+    if content_to_parse.startswith('```'):
+        # 最初の```行を削除
+        first_newline = content_to_parse.find('\n')
+        if first_newline != -1:
+            content_to_parse = content_to_parse[first_newline+1:]
+        # 最後の```を削除
+        last_backticks = content_to_parse.rfind('```')
+        if last_backticks != -1:
+            content_to_parse = content_to_parse[:last_backticks]
+    return content_to_parse
+
+def _loads(content_to_parse: str, batch: bool):
+    # JSONのパース時間と失敗を記録する (失敗時は None)
+    started = time.perf_counter()
+    try:
+        value = json.loads(content_to_parse)
+    except json.JSONDecodeError:
+        logger.warning("JSONパースエラー: %s", content_to_parse)
+        value = None
+    metrics.record("ocr.parse", (time.perf_counter() - started) * 1000, ok=value is not None, batch=batch)
+    return value
+
+def parse_card(raw_content: str) -> Card:
+    content_to_parse = strip_code_fence(raw_content)
+    logger.debug("パース対象: %s", content_to_parse)
+
+    card = _loads(content_to_parse, batch=False)
+    if not isinstance(card, dict):
+        return empty_card("parse_failed")
+    # 各フィールドの存在を確認
+    for field in REQUIRED_FIELDS:
+        if field not in card:
+            card[field] = None
+    return card
+
+def _data_uri(f) -> str:
+    # 形式判定・回転補正・縮小を行ってから、実際の形式でdata URIを生成
+    image = prepare_image(f.getvalue())
+    return f"data:{image['mime_type']};base64," + base64.b64encode(image["data"]).decode()
+
+def _create(client, **kwargs):
+    # レート制限の残量を知るため、応答ヘッダーも受け取る
+    completions = client.chat.completions
+    raw_api = getattr(completions, "with_raw_response", None)
+    if raw_api is None:
+        return completions.create(**kwargs), {}
+    raw = raw_api.create(**kwargs)
+    return raw.parse(), raw.headers
+
+def estimate_tokens(images: int, detail: str) -> int:
+    # TPMの見積もり: プロンプト + 画像 (low: 85 / high: 約765 トークン) + 応答
+    return 500 + images * ((85 if detail == "low" else 765) + 200)
+
+def _complete(client, data_uris: List[str], detail: str, system_prompt: str, model: str | None = None) -> str:
+    started = time.perf_counter()
+    resp = scheduler.call(lambda: _create(
+        client,
+        model=model or MODEL,
+        temperature=0,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": uri, "detail": detail}}
+                for uri in data_uris
+            ]},
+        ],
+    ), estimate_tokens(len(data_uris), detail))
+
+    # APIの所要時間・トークン数・送信した画像のバイト数を記録
+    usage = getattr(resp, "usage", None)
+    metrics.record(
+        "ocr.request", (time.perf_counter() - started) * 1000,
+        detail=detail, images=len(data_uris),
+        image_bytes=sum(len(uri) for uri in data_uris),
+        prompt_tokens=getattr(usage, "prompt_tokens", None) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", None) or 0,
+    )
+
+    # デバッグ用に生のAPIレスポンスを記録
+    raw_content = resp.choices[0].message.content
+    logger.debug("OCR結果 (detail=%s, 画像%d枚): %s", detail, len(data_uris), raw_content)
+    return raw_content
+
+def _request(client, data_uri: str, detail: str, model: str | None = None) -> Card:
+    card = parse_card(_complete(client, [data_uri], detail, SYSTEM_PROMPT, model))
+    # 壊れたJSONが返ってきたカードだけ再リクエストする
+    for _ in range(OCR_PARSE_RETRIES):
+        if card.get("error") != "parse_failed":
+            break
+        metrics.record("ocr.parse_retry", detail=detail)
+        card = parse_card(_complete(client, [data_uri], detail, SYSTEM_PROMPT, model))
+    return card
+
+def _needs_retry(card: Card) -> bool:
+    return "error" in card or any(card.get(field) is None for field in KEY_FIELDS)
+
+def ocr_one(f, client=None, detail: str | None = None, model: str | None = None) -> Card:
+    client = client or get_client()
+    detail = detail or OCR_DETAIL
+    data_uri = _data_uri(f)
+
+    if detail != "adaptive":
+        return _request(client, data_uri, detail, model)
+    card = _request(client, data_uri, "low", model)
+    if _needs_retry(card):
+        card = _request(client, data_uri, "high", model)
+    return card
+
+def parse_cards(raw_content: str, expected: int) -> List[Card] | None:
+    # 画像枚数と同じ要素数のJSON配列でなければ None (呼び出し側で1枚ずつに切り替える)
+    content_to_parse = strip_code_fence(raw_content)
+    cards = _loads(content_to_parse, batch=True)
+    if cards is None:
+        return None
+    if not isinstance(cards, list) or len(cards) != expected or not all(isinstance(c, dict) for c in cards):
+        logger.warning("バッチ応答の件数不一致: 期待 %d 件", expected)
+        metrics.record("ocr.batch_mismatch", expected=expected)
+        return None
+    for card in cards:
+        for field in REQUIRED_FIELDS:
+            if field not in card:
+                card[field] = None
+    return cards
+
+def ocr_batch(files, client=None, detail: str | None = None, model: str | None = None) -> List[Card]:
+    # 複数枚を1リクエストにまとめ、システムプロンプトの再送と往復回数を減らす
+    client = client or get_client()
+    detail = detail or OCR_DETAIL
+    data_uris = [_data_uri(f) for f in files]
+
+    first = "low" if detail == "adaptive" else detail
+    cards = parse_cards(_complete(client, data_uris, first, BATCH_PROMPT, model), len(files))
+    if cards is None:
+        return [ocr_one(f, client, detail, model) for f in files]
+    if detail == "adaptive":
+        # 主要フィールドが取れなかったカードだけ high で1枚ずつ再解析する
+        cards = [_request(client, uri, "high", model) if _needs_retry(card) else card
+                 for uri, card in zip(data_uris, cards)]
+    return cards
+
+def _ocr_safe(f, client, model: str | None = None) -> Card:
+    # 1枚の失敗でバッチ全体を落とさない
+    with metrics.timer("ocr.card") as m:
         try:
-            card = json.loads(content_to_parse)
-            # 各フィールドの存在を確認
-            required_fields = ["name", "company", "email", "phone", "department", "job_title", "qualification", "company_address", "company_url", "company_phone", "company_fax"]
-            for field in required_fields:
-                if field not in card:
-                    card[field] = None
-            out.append(card)
-        except json.JSONDecodeError:
-            print("JSONパースエラー: ", content_to_parse)
-            out.append({"error": "parse_failed", "name": None, "company": None, "email": None, "phone": None, "department": None, "job_title": None, "qualification": None, "company_address": None, "company_url": None, "company_phone": None, "company_fax": None})
+            card = ocr_one(f, client, model=model)
+        except Exception as e:
+            logger.warning("OCRリクエストエラー: %s", e)
+            card = empty_card("request_failed")
+        m["failed"] = "error" in card
+        return card
+
+def _ocr_group(group, client, model: str | None = None) -> List[Card]:
+    if len(group) == 1:
+        return [_ocr_safe(group[0], client, model)]
+    try:
+        return ocr_batch(group, client, model=model)
+    except Exception as e:
+        # まとめたリクエスト自体が失敗した場合は1枚ずつ処理する
+        logger.warning("バッチOCRリクエストエラー: %s", e)
+        return [_ocr_safe(f, client, model) for f in group]
+
+class OpenAIBackend(Backend):
+    # Visionモデルによる解析 (バッチ・adaptive・再試行は上の関数と同じ)
+    def __init__(self, client=None, model: str | None = None):
+        self.client = client
+        self.model = model or MODEL
+        self.name = f"openai:{self.model}"
+
+    def recognize(self, files) -> List[Card]:
+        return _ocr_group(list(files), self.client or get_client(), self.model)
+
+def get_backends(client=None, names: str | None = None) -> List[Backend]:
+    # OCR_BACKENDS の設定からバックエンドのチェーンを作る
+    backends = []
+    for name in (names or OCR_BACKENDS).split(","):
+        name = name.strip()
+        if name == "openai":
+            backends.append(OpenAIBackend(client))
+        elif name == "tesseract":
+            backends.append(TesseractBackend())
+        elif name == "stub":
+            backends.append(StubBackend())
+        elif name:
+            raise ValueError(f"unknown OCR backend: {name}")
+    if not backends:
+        raise ValueError("OCR_BACKENDS is empty")
+    return backends
+
+def _match_similar(files, pending, namespace: str) -> Tuple[dict, dict]:
+    # 新しく解析する画像の知覚ハッシュを計算し、過去に解析した画像・同じバッチ内の先の画像とほぼ同じものを探す
+    # (キー → ハッシュ, キー → SimilarImage) を返す
+    hashes = {}
+    for key, idxs in pending.items():
+        value = preprocess.dhash(files[idxs[0]].getvalue())
+        if value is not None:
+            hashes[key] = value
+    matches = {key: {"key": source, "distance": distance, "source": "history"}
+               for key, (source, distance) in cache.find_similar(hashes, OCR_SIMILAR_DISTANCE, namespace).items()}
+    leaders = []
+    for key, value in hashes.items():
+        if key in matches:
+            continue
+        best = min(((preprocess.hamming(value, v), k) for k, v in leaders), default=None)
+        if best is not None and best[0] <= OCR_SIMILAR_DISTANCE:
+            matches[key] = {"key": best[1], "distance": best[0], "source": "batch",
+                            "name": files[pending[best[1]][0]].name}
+        else:
+            leaders.append((key, value))
+    return hashes, matches
+
+def iter_ocr(files, max_workers: int | None = None, client=None, use_cache: bool = True,
+             batch_size: int | None = None, backends: List[Backend] | None = None,
+             reuse_similar: bool | None = None) -> Iterator[Tuple[int, Card]]:
+    # 解析が終わったカードから順に (入力順のインデックス, カード) を返す
+    # backends を省略した場合は OCR_BACKENDS の設定 (client はVisionモデルのバックエンドに渡す)
+    # reuse_similar を省略した場合は OCR_SIMILAR_REUSE の設定
+    files = list(files)
+    if not files:
+        return
+    backends = backends or get_backends(client)
+
+    with metrics.timer("ocr.batch", cards=len(files)) as m:
+        # 同じ画像は (再アップロードでもバッチ内の重複でも) 1回だけAPIに問い合わせる
+        # バックエンドの構成・前処理や解析精度の設定が変わった場合も別キーになるようにする
+        version = f"{PROMPT_VERSION}:{OCR_DETAIL}:{preprocess.OCR_MAX_EDGE}"
+        keys = [cache.cache_key(f.getvalue(), chain_name(backends), version) for f in files]
+        # ほぼ同じ画像の照合も、同じ構成・設定で解析した結果の中だけで行う
+        namespace = f"{chain_name(backends)}|{version}"
+        cached = cache.get_many(keys) if use_cache else {}
+        pending = {}
+        for i, key in enumerate(keys):
+            if key in cached:
+                yield i, dict(cached[key])
+            else:
+                pending.setdefault(key, []).append(i)
+        m["cache_hits"] = len(files) - sum(len(idxs) for idxs in pending.values())
+
+        # ほぼ同じ画像 (撮り直し・再スキャン) には印を付ける
+        # 再利用を有効にした場合だけ、APIに送らずに解析済みの結果を返す
+        hashes, followers, flagged = {}, {}, {}
+        if use_cache and OCR_SIMILAR_DISTANCE >= 0 and pending:
+            hashes, matches = _match_similar(files, pending, namespace)
+            reuse = OCR_SIMILAR_REUSE if reuse_similar is None else reuse_similar
+            previous = cache.get_many([match["key"] for match in matches.values()
+                                       if match["source"] == "history"]) if reuse else {}
+            reused = 0
+            for key, match in matches.items():
+                if not reuse or (match["source"] == "history" and match["key"] not in previous):
+                    flagged[key] = dict(match, reused=False)
+                    continue
+                match["reused"] = True
+                idxs = pending.pop(key)
+                reused += len(idxs)
+                if match["source"] == "batch":
+                    followers.setdefault(match["key"], []).append((idxs, match))
+                    continue
+                for i in idxs:
+                    yield i, dict(previous[match["key"]], similar_to=match)
+            m["similar_flagged"] = len(flagged)
+            m["similar_reused"] = reused
+        m["requested"] = len(pending)
+        if not pending:
+            return
+
+        todo = list(pending.items())
+        size = max(1, batch_size or OCR_BATCH_SIZE)
+        batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+        # (リクエストにまとめる画像, 見積もったメモリ使用量)
+        groups = deque((group, sum(spool.size_of(files[idxs[0]]) for _, idxs in group) * IMAGE_MEMORY_FACTOR)
+                       for group in batches)
+        workers = max(1, min(max_workers or OCR_MAX_WORKERS, len(groups)))
+        # 待ち時間の大半はネットワークなのでスレッドで並列化する
+        # 画像は各スレッドが処理を始める時に読み込むので、同時に投げるリクエストをメモリの上限内に抑える
+        pool = ThreadPoolExecutor(max_workers=workers)
+        running = {}
+        try:
+            while groups or running:
+                while groups and len(running) < workers:
+                    group, need = groups[0]
+                    # 処理中のリクエストがあれば待たずに結果の受け取りに戻る (無ければ他の呼び出しが空けるまで待つ)
+                    if not memory_budget.acquire(need, block=not running):
+                        break
+                    groups.popleft()
+                    future = pool.submit(run_chain, [files[idxs[0]] for _, idxs in group], backends,
+                                         KEY_FIELDS, REQUIRED_FIELDS)
+                    # 完了・取り消しのどちらでも確保した分を戻す
+                    future.add_done_callback(lambda _, need=need: memory_budget.release(need))
+                    running[future] = group
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                future = next(iter(done))
+                group, results = running.pop(future), future.result()
+                if use_cache:
+                    cache.put_many({key: card for (key, _), card in zip(group, results)})
+                    cache.put_hashes({key: hashes[key] for (key, _), card in zip(group, results)
+                                      if key in hashes and "error" not in card}, namespace)
+                for (key, idxs), card in zip(group, results):
+                    for i in idxs:
+                        yield i, dict(card, similar_to=flagged[key]) if key in flagged else dict(card)
+                    for follower_idxs, match in followers.get(key, []):
+                        for i in follower_idxs:
+                            yield i, dict(card, similar_to=match) if "error" not in card else dict(card)
+        finally:
+            # 途中で読み捨てられた場合は未着手のリクエストを取り消す
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def ocr_many(files, max_workers: int | None = None, client=None, use_cache: bool = True,
+             batch_size: int | None = None, on_result: Callable[[int, Card], None] | None = None,
+             backends: List[Backend] | None = None, reuse_similar: bool | None = None) -> List[Card]:
+    files = list(files)
+    out: List[Card | None] = [None] * len(files)
+    for i, card in iter_ocr(files, max_workers, client, use_cache, batch_size, backends, reuse_similar):
+        out[i] = card
+        if on_result is not None:
+            on_result(i, card)
     return out
@@ -0,0 +1,112 @@
+# preprocess.py
+# API送信前の画像前処理 (形式判定・EXIF回転補正・縮小・再圧縮)
+import io
+import os
+import time
+import logging
+import threading
+from typing import Dict
+from models import PreparedImage
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillowが無い環境では形式判定のみ行い、そのまま送る
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# 長辺の最大ピクセル数 (名刺の文字が読める程度に縮小する)
+OCR_MAX_EDGE = int(os.environ.get("OCR_MAX_EDGE", "1600"))
+# 再圧縮時のJPEG品質
+OCR_JPEG_QUALITY = int(os.environ.get("OCR_JPEG_QUALITY", "85"))
+
+_stats = {"images": 0, "bytes_before": 0, "bytes_after": 0}
+_stats_lock = threading.Lock()
+
+def stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+def detect_mime(data: bytes) -> str:
+    # 拡張子ではなくファイル先頭のマジックバイトで判定する
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
+
+def _recompress(data: bytes, max_edge: int, quality: int) -> tuple[bytes | None, bool]:
+    img = Image.open(io.BytesIO(data))
+    # EXIF Orientation (0x0112) が 1 以外なら回転補正が必要
+    needs_rotate = img.getexif().get(0x0112, 1) != 1
+    if needs_rotate:
+        img = ImageOps.exif_transpose(img)
+    needs_resize = max(img.size) > max_edge
+    if not needs_rotate and not needs_resize:
+        return None, False
+    if needs_resize:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if img.mode in ("RGBA", "LA", "P"):
+        # 透過部分は白で埋めてからJPEGにする
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue(), needs_rotate
+
+def prepare_image(data: bytes, max_edge: int | None = None, quality: int | None = None) -> PreparedImage:
+    started = time.perf_counter()
+    max_edge = max_edge or OCR_MAX_EDGE
+    quality = quality or OCR_JPEG_QUALITY
+    out, mime = data, detect_mime(data)
+    if Image is not None:
+        try:
+            recompressed, rotated = _recompress(data, max_edge, quality)
+        except Exception as e:
+            logger.warning("画像前処理エラー (元画像をそのまま送信): %s", e)
+            recompressed, rotated = None, False
+        # 回転補正が不要で、再圧縮しても小さくならない場合は元画像を使う
+        if recompressed is not None and (rotated or len(recompressed) < len(data)):
+            out, mime = recompressed, "image/jpeg"
+    with _stats_lock:
+        _stats["images"] += 1
+        _stats["bytes_before"] += len(data)
+        _stats["bytes_after"] += len(out)
+    metrics.record("preprocess", (time.perf_counter() - started) * 1000,
+                   bytes_before=len(data), bytes_after=len(out), mime_type=mime)
+    return {"data": out, "mime_type": mime, "bytes_before": len(data), "bytes_after": len(out)}
+
+def dhash(data: bytes, size: int = 8) -> int | None:
+    # 知覚ハッシュ (dHash): 縮小したグレースケール画像の隣り合う画素の明暗で size*size ビットを作る
+    # 再圧縮・縮小・多少の明るさの違いではほとんど変わらない (Pillowが無い・読めない画像は None)
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEGは縮小しながらデコードして高速化する
+        img.draft("L", (size * 8, size * 8))
+        if img.getexif().get(0x0112, 1) != 1:
+            img = ImageOps.exif_transpose(img)
+        img = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    except Exception as e:
+        logger.debug("知覚ハッシュの計算エラー: %s", e)
+        return None
+    px = img.tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            value = value << 1 | (px[i] > px[i + 1])
+    return value
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
@@ -0,0 +1,237 @@
+# ratelimit.py
+# OCRリクエストのスケジューラー
+#   - トークンバケットでRPM (リクエスト数/分) とTPM (トークン数/分) を超えないように送る
+#     上限・残量はAPIの x-ratelimit-* ヘッダーを見て随時更新する
+#   - 429 / 5xx / 接続エラーは指数バックオフ (ジッター付き) で再試行する
+#   - 障害が続いた場合はサーキットブレーカーで一定時間リクエストを止める
+import os
+import re
+import time
+import random
+import logging
+import threading
+from typing import Callable, Mapping, Tuple
+from openai import APIConnectionError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ヘッダーを受け取るまでの初期値 (アカウントの上限に合わせて設定する)
+OCR_RPM_LIMIT = int(os.environ.get("OCR_RPM_LIMIT", "500"))
+OCR_TPM_LIMIT = int(os.environ.get("OCR_TPM_LIMIT", "30000"))
+# 再試行の回数と待ち時間 (秒)
+OCR_MAX_RETRIES = int(os.environ.get("OCR_MAX_RETRIES", "5"))
+OCR_RETRY_BASE = float(os.environ.get("OCR_RETRY_BASE", "0.5"))
+OCR_RETRY_MAX = float(os.environ.get("OCR_RETRY_MAX", "30"))
+# 連続でこの回数失敗したら、OCR_BREAKER_COOLDOWN 秒間リクエストを止める
+OCR_BREAKER_THRESHOLD = int(os.environ.get("OCR_BREAKER_THRESHOLD", "5"))
+OCR_BREAKER_COOLDOWN = float(os.environ.get("OCR_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    # 1分あたり limit 個を均等に補充するバケット
+    # 残量がマイナスでも取り出せる (1リクエストが大きくても待ち続けない)。次の呼び出しは0に戻るまで待つ
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.tokens = float(limit) / 60
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def capacity(self) -> float:
+        # 1秒分より多くは貯めない (上限いっぱいのバーストで429を招かないように)
+        return max(1.0, self.limit / 60)
+
+    def _refill(self, now: float):
+        rate = self.limit / 60
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def acquire(self, n: float = 1) -> float:
+        # 取り出せるまで待ち、待った秒数を返す
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= 0:
+                    self.tokens -= n
+                    return waited
+                if wait <= 0:
+                    wait = -self.tokens / (self.limit / 60)
+            time.sleep(wait)
+            waited += wait
+
+    def adjust(self, n: float):
+        # 見積もりと実際の使用量の差を反映する
+        with self.lock:
+            self.tokens -= n
+
+    def update(self, limit: int | None = None, remaining: int | None = None, reset: float | None = None):
+        with self.lock:
+            self._refill(time.monotonic())
+            if limit and limit > 0:
+                self.limit = limit
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining <= 0 and reset:
+                    self._pause(reset)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self._pause(seconds)
+
+    def _pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            # 開いてから cooldown 秒経ったら1件だけ試す (half-open)
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial:
+                raise CircuitOpenError("OCR API is temporarily unavailable")
+            self.trial = True
+
+    def remaining(self) -> float:
+        # 次にリクエストを試せるまでの秒数 (閉じていれば 0)
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial:
+                    logger.warning("OCR APIの障害が続いているため %.0f 秒間リクエストを停止します", self.cooldown)
+                    metrics.record("ocr.breaker_open", failures=self.failures)
+                self.opened_at, self.trial = time.monotonic(), False
+
+
+def parse_duration(value: str | None) -> float | None:
+    # "1s" / "6m0s" / "20ms" / "1h2m3.5s" のような形式を秒に変換する
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    unit = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(n) * unit[u] for n, u in parts)
+
+
+def _int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _headers(e: Exception) -> Mapping[str, str]:
+    response = getattr(e, "response", None)
+    return getattr(response, "headers", None) or {}
+
+
+def is_retryable(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return isinstance(e, (APIConnectionError, ConnectionError, TimeoutError))
+
+
+class Scheduler:
+    def __init__(self, rpm: int | None = None, tpm: int | None = None, max_retries: int | None = None,
+                 retry_base: float | None = None, retry_max: float | None = None,
+                 breaker_threshold: int | None = None, breaker_cooldown: float | None = None):
+        self.requests = TokenBucket(rpm or OCR_RPM_LIMIT)
+        self.tokens = TokenBucket(tpm or OCR_TPM_LIMIT)
+        self.max_retries = OCR_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_base = OCR_RETRY_BASE if retry_base is None else retry_base
+        self.retry_max = OCR_RETRY_MAX if retry_max is None else retry_max
+        self.breaker = CircuitBreaker(breaker_threshold or OCR_BREAKER_THRESHOLD,
+                                      OCR_BREAKER_COOLDOWN if breaker_cooldown is None else breaker_cooldown)
+
+    def observe(self, headers: Mapping[str, str]):
+        # 応答ヘッダーの上限・残量でバケットを補正する
+        self.requests.update(_int(headers.get("x-ratelimit-limit-requests")),
+                             _int(headers.get("x-ratelimit-remaining-requests")),
+                             parse_duration(headers.get("x-ratelimit-reset-requests")))
+        self.tokens.update(_int(headers.get("x-ratelimit-limit-tokens")),
+                           _int(headers.get("x-ratelimit-remaining-tokens")),
+                           parse_duration(headers.get("x-ratelimit-reset-tokens")))
+
+    def _backoff(self, attempt: int, headers: Mapping[str, str]) -> float:
+        # full jitter: 0 〜 base * 2^attempt の一様乱数。retry-after があればそれ以上待つ
+        delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** attempt))
+        if headers.get("retry-after-ms"):
+            retry_after = parse_duration(headers["retry-after-ms"] + "ms")
+        else:
+            retry_after = parse_duration(headers.get("retry-after"))
+        return max(delay, retry_after or 0)
+
+    def call(self, fn: Callable[[], Tuple[object, Mapping[str, str]]], tokens: int) -> object:
+        # fn は (レスポンス, ヘッダー) を返す。見積もりトークン数だけTPMバケットから取り出してから呼ぶ
+        attempt = 0
+        while True:
+            self.breaker.before()
+            waited = self.requests.acquire(1) + self.tokens.acquire(tokens)
+            if waited > 0:
+                metrics.record("ocr.throttle", waited * 1000)
+            try:
+                resp, headers = fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    # 4xx はAPI自体には届いているので障害として数えない
+                    self.breaker.success()
+                    raise
+                status = getattr(e, "status_code", None)
+                headers = _headers(e)
+                if status == 429:
+                    # 上限に達したので全スレッドの送信を止め、ヘッダーの値で上限を更新する
+                    self.breaker.success()
+                    self.observe(headers)
+                    self.requests.pause(self._backoff(0, headers))
+                else:
+                    self.breaker.failure()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, headers)
+                metrics.record("ocr.retry", delay * 1000, status=str(status or type(e).__name__), attempt=attempt + 1)
+                logger.info("OCRリクエストを %.2f 秒後に再試行します (%s)", delay, e)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            self.observe(headers)
+            usage = getattr(resp, "usage", None)
+            used = getattr(usage, "total_tokens", None)
+            if used:
+                self.tokens.adjust(used - tokens)
+            return resp
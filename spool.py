@@ -0,0 +1,117 @@
+# spool.py
+# アップロード画像の一時置き場 (ディスク)
+# 撮影画像などをセッションに溜め込むとStreamlitのプロセスのメモリが増え続けるので、受け取った時点でファイルに書き出し、
+# OCRやジョブ登録の時だけ読み戻す
+import os
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+OCR_SPOOL_DIR = os.environ.get("OCR_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "bizcard_spool")
+# 読み書きの単位
+CHUNK_SIZE = 1 << 20
+# 期限切れ・放置されたセッションの一時ファイルを、書き出しからこの秒数が過ぎたら削除する
+OCR_SPOOL_MAX_AGE_SEC = float(os.environ.get("OCR_SPOOL_MAX_AGE_SEC", "86400"))
+# 古いファイルを探す間隔 (秒)
+SWEEP_INTERVAL = 3600
+
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+class SpooledFile:
+    # st.file_uploader の UploadedFile と同じインターフェース (name / getvalue)
+    # source_id: 元の UploadedFile の file_id
+    def __init__(self, name: str, path: str, size: int, source_id: str | None = None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.source_id = source_id
+
+    def getvalue(self) -> bytes:
+        with open(self.path, "rb") as fp:
+            return fp.read()
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self.path, "rb") as fp:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def size_of(f) -> int:
+    size = getattr(f, "size", None)
+    return size if size is not None else len(f.getvalue())
+
+
+def iter_chunks(f, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    # SpooledFile などは少しずつ読む。それ以外は getvalue() を分割して返す
+    if hasattr(f, "iter_chunks"):
+        yield from f.iter_chunks(chunk_size)
+        return
+    view = memoryview(f.getvalue())
+    for i in range(0, len(view), chunk_size):
+        yield view[i:i + chunk_size]
+
+
+def spill(f, directory: str | None = None) -> SpooledFile:
+    # アップロードされたファイルを一時ディレクトリに少しずつ書き出す
+    directory = directory or OCR_SPOOL_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, uuid.uuid4().hex)
+    size = 0
+    with open(path, "wb") as fp:
+        if hasattr(f, "read") and hasattr(f, "seek"):
+            f.seek(0)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(chunk)
+                size += len(chunk)
+        else:
+            for chunk in iter_chunks(f):
+                fp.write(chunk)
+                size += len(chunk)
+    return SpooledFile(f.name, path, size, getattr(f, "file_id", None))
+
+
+def sweep(directory: str | None = None, max_age: float | None = None, force: bool = False) -> int:
+    # 書き出しから max_age 秒以上経った一時ファイルを削除し、削除した数を返す
+    # (セッションの期限切れ・プロセスの異常終了で残ったファイルの掃除用。毎回の再描画で呼んでも SWEEP_INTERVAL に1回だけ走査する)
+    global _last_sweep
+    with _sweep_lock:
+        now = time.time()
+        if not force and now - _last_sweep < SWEEP_INTERVAL:
+            return 0
+        _last_sweep = now
+    directory = directory or OCR_SPOOL_DIR
+    max_age = OCR_SPOOL_MAX_AGE_SEC if max_age is None else max_age
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime >= max_age:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info("古い一時ファイルを %d 件削除しました", removed)
+    return removed
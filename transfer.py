@@ -0,0 +1,297 @@
+# transfer.py
+# 連絡先の一括エクスポート・インポート (CSV / vCard / JSONL)
+#   エクスポート: DBのカーソルから少しずつ読みながらファイルへ書く
+#   インポート: ファイルを少しずつ読み、chunk_size 件ごとに db.save_cards で1トランザクションずつ保存する
+# どちらも全件をメモリに載せないので、数十万件の移行でもメモリ使用量は一定
+import csv
+import json
+import time
+import logging
+from typing import Callable, Dict, IO, Iterable, Iterator
+from models import Card
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "vcard", "jsonl")
+EXTENSIONS = {".csv": "csv", ".vcf": "vcard", ".vcard": "vcard", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+# 1トランザクションで保存する件数
+IMPORT_CHUNK_SIZE = 1000
+
+
+def detect_format(path: str) -> str:
+    for ext, fmt in EXTENSIONS.items():
+        if path.lower().endswith(ext):
+            return fmt
+    raise ValueError(f"cannot infer format from {path!r} (use one of {', '.join(FORMATS)})")
+
+
+def _value(value) -> str | None:
+    # 空文字・空白だけの値は None として扱う (OCR結果と同じ表現にする)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+# ---- CSV ----
+
+def write_csv(fp: IO[str], cards: Iterable[Card]) -> int:
+    writer = csv.writer(fp)
+    writer.writerow(db.CARD_FIELDS)
+    count = 0
+    for card in cards:
+        writer.writerow(["" if card.get(f) is None else card[f] for f in db.CARD_FIELDS])
+        count += 1
+    return count
+
+
+def read_csv(fp: IO[str]) -> Iterator[Card]:
+    # 見出し行の列名で対応付ける (知らない列は無視する)
+    for row in csv.DictReader(fp):
+        yield {f: _value(row.get(f)) for f in db.CARD_FIELDS}
+
+
+# ---- JSONL ----
+
+def write_jsonl(fp: IO[str], cards: Iterable[Card]) -> int:
+    count = 0
+    for card in cards:
+        fp.write(json.dumps({f: card.get(f) for f in db.CARD_FIELDS}, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def read_jsonl(fp: IO[str]) -> Iterator[Card]:
+    for lineno, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning("JSONLの %d 行目を読み飛ばしました", lineno)
+            continue
+        if isinstance(obj, dict):
+            yield {f: _value(obj.get(f)) for f in db.CARD_FIELDS}
+
+
+# ---- vCard (3.0) ----
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace(",", "\\,").replace(";", "\\;")
+
+
+def _unescape(value: str) -> str:
+    out, chars = [], iter(value)
+    for ch in chars:
+        if ch == "\\":
+            nxt = next(chars, "")
+            out.append("\n" if nxt in ("n", "N") else nxt)
+        else:
+            out.append(ch)
+    return "".join(out)
+
+
+def _split(value: str, sep: str) -> list:
+    # エスケープされていない区切り文字で分割する
+    parts, current, chars = [], [], iter(value)
+    for ch in chars:
+        if ch == "\\":
+            current.append(ch + next(chars, ""))
+        elif ch == sep:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+    parts.append("".join(current))
+    return parts
+
+
+def _fold(line: str) -> str:
+    # 1行75オクテットを超える場合は折り返す (マルチバイト文字の途中では切らない)
+    if len(line.encode()) <= 75:
+        return line + "\r\n"
+    out, current, size = [], "", 0
+    for ch in line:
+        n = len(ch.encode())
+        if size + n > 75:
+            out.append(current)
+            current, size = " ", 1
+        current += ch
+        size += n
+    out.append(current)
+    return "\r\n".join(out) + "\r\n"
+
+
+def _vcard(card: Card) -> str:
+    def e(field):
+        return _escape(card.get(field) or "")
+
+    lines = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{e('name')}", f"N:{e('name')};;;;"]
+    if card.get("company") or card.get("department"):
+        lines.append(f"ORG:{e('company')};{e('department')}")
+    if card.get("job_title"):
+        lines.append(f"TITLE:{e('job_title')}")
+    if card.get("qualification"):
+        lines.append(f"X-QUALIFICATION:{e('qualification')}")
+    if card.get("email"):
+        lines.append(f"EMAIL;TYPE=INTERNET:{e('email')}")
+    if card.get("phone"):
+        lines.append(f"TEL;TYPE=CELL:{e('phone')}")
+    if card.get("company_phone"):
+        lines.append(f"TEL;TYPE=WORK,VOICE:{e('company_phone')}")
+    if card.get("company_fax"):
+        lines.append(f"TEL;TYPE=WORK,FAX:{e('company_fax')}")
+    if card.get("company_address"):
+        lines.append(f"ADR;TYPE=WORK:;;{e('company_address')};;;;")
+    if card.get("company_url"):
+        lines.append(f"URL:{e('company_url')}")
+    lines.append("END:VCARD")
+    return "".join(_fold(line) for line in lines)
+
+
+def write_vcard(fp: IO[str], cards: Iterable[Card]) -> int:
+    count = 0
+    for card in cards:
+        fp.write(_vcard(card))
+        count += 1
+    return count
+
+
+def _unfold(fp: IO[str]) -> Iterator[str]:
+    # 空白・タブで始まる行は前の行の続き
+    current = None
+    for line in fp:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _card_from_vcard(props: list) -> Card:
+    card: Card = {f: None for f in db.CARD_FIELDS}
+    for name, params, value in props:
+        if name == "FN":
+            card["name"] = _value(_unescape(value))
+        elif name == "N" and not card["name"]:
+            # FN が無い場合は 姓;名 をつなげる
+            parts = [_unescape(p) for p in _split(value, ";")]
+            card["name"] = _value(" ".join(p for p in parts[:2] if p))
+        elif name == "ORG":
+            parts = [_value(_unescape(p)) for p in _split(value, ";")]
+            card["company"] = parts[0]
+            card["department"] = parts[1] if len(parts) > 1 else None
+        elif name == "TITLE":
+            card["job_title"] = _value(_unescape(value))
+        elif name == "X-QUALIFICATION":
+            card["qualification"] = _value(_unescape(value))
+        elif name == "EMAIL" and not card["email"]:
+            card["email"] = _value(_unescape(value))
+        elif name == "TEL":
+            if "FAX" in params:
+                field = "company_fax"
+            elif "CELL" in params:
+                field = "phone"
+            elif "WORK" in params:
+                field = "company_phone"
+            else:
+                field = "phone" if not card["phone"] else "company_phone"
+            card[field] = card[field] or _value(_unescape(value))
+        elif name == "ADR" and not card["company_address"]:
+            # 私書箱;拡張住所;番地;市区町村;都道府県;郵便番号;国 をつなげる
+            parts = [_unescape(p) for p in _split(value, ";")]
+            card["company_address"] = _value(" ".join(p for p in parts if p))
+        elif name == "URL" and not card["company_url"]:
+            card["company_url"] = _value(_unescape(value))
+    return card
+
+
+def read_vcard(fp: IO[str]) -> Iterator[Card]:
+    props = None
+    for line in _unfold(fp):
+        if ":" not in line:
+            continue
+        head, value = line.split(":", 1)
+        # "item1.TEL;TYPE=WORK" のようなグループ名と、パラメータを分ける
+        name, *params = head.split(";")
+        name = name.rsplit(".", 1)[-1].upper()
+        params = {p.upper() for param in params for p in param.split("=")[-1].split(",")}
+        if name == "BEGIN" and value.upper() == "VCARD":
+            props = []
+        elif name == "END" and value.upper() == "VCARD":
+            if props is not None:
+                yield _card_from_vcard(props)
+            props = None
+        elif props is not None:
+            props.append((name, params, value))
+
+
+WRITERS: Dict[str, Callable[[IO[str], Iterable[Card]], int]] = {
+    "csv": write_csv, "vcard": write_vcard, "jsonl": write_jsonl,
+}
+READERS: Dict[str, Callable[[IO[str]], Iterator[Card]]] = {
+    "csv": read_csv, "vcard": read_vcard, "jsonl": read_jsonl,
+}
+
+
+def _open(path: str, mode: str, fmt: str) -> IO[str]:
+    # CSVはExcelで文字化けしないようBOM付きで書く (読み込み時はBOMの有無どちらでもよい)
+    # 改行コードは変換しない (vCardはCRLF、CSVはcsvモジュールが扱う)
+    encoding = "utf-8-sig" if fmt == "csv" else "utf-8"
+    return open(path, mode, encoding=encoding, newline="")
+
+
+def export_contacts(path: str, fmt: str | None = None, chunk_size: int = 1000) -> Dict[str, float]:
+    fmt = fmt or detect_format(path)
+    with metrics.timer("transfer.export", format=fmt) as m:
+        with _open(path, "w", fmt) as fp:
+            count = WRITERS[fmt](fp, db.iter_contacts(chunk_size))
+        m["rows"] = count
+    return {"rows": count}
+
+
+def import_cards(cards: Iterable[Card], chunk_size: int | None = None,
+                 on_chunk: Callable[[Dict[str, int]], None] | None = None) -> Dict[str, int]:
+    # save_cards と同じくメールアドレスをキーにupsertする (メールアドレスの無い行は保存しない)
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    summary = {"rows": 0, "inserted": 0, "updated": 0, "skipped": 0}
+    chunk = []
+
+    def flush():
+        saved = db.save_cards(chunk)
+        summary["inserted"] += saved["inserted"]
+        summary["updated"] += saved["updated"]
+        chunk.clear()
+        if on_chunk is not None:
+            on_chunk(dict(summary))
+
+    for card in cards:
+        summary["rows"] += 1
+        if not db.normalize_email(card.get("email")):
+            summary["skipped"] += 1
+            continue
+        chunk.append(card)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return summary
+
+
+def import_contacts(path: str, fmt: str | None = None, chunk_size: int | None = None,
+                    on_chunk: Callable[[Dict[str, int]], None] | None = None) -> Dict[str, int]:
+    fmt = fmt or detect_format(path)
+    db.init_db()
+    started = time.perf_counter()
+    with _open(path, "r", fmt) as fp:
+        summary = import_cards(READERS[fmt](fp), chunk_size, on_chunk)
+    metrics.record("transfer.import", (time.perf_counter() - started) * 1000, format=fmt, **summary)
+    return summary
+
@@ -1,26 +1,49 @@
 # ui.py
+import uuid
 import streamlit as st
 import pandas as pd
 from models import Card, State
-from db import get_all_contacts
-from ocr import ocr_many
-from graph import check_dup, apply_decision, save_node
+from db import list_contacts, search_contacts, count_contacts
+import jobs
+from graph import create_graph, open_checkpointer, start_batch, resume_batch, get_batch, paused_batches, dup_key
+import cache
+import metrics
+import preprocess
+import spool
+
+@st.cache_resource
+def get_graph():
+    # 重複確認で一時停止したバッチはチェックポイントDBに残り、セッションが切れても再開できる
+    return create_graph(open_checkpointer())
 
 def init_session_state():
-    if "dup_cards" not in st.session_state: st.session_state.dup_cards = None
-    if "current_state" not in st.session_state: st.session_state.current_state = None
+    # URLのバッチIDを引き継ぐ (ブラウザを再読み込みしても重複確認の途中から再開する)
+    if "batch_id" not in st.session_state: st.session_state.batch_id = st.query_params.get("batch")
+    # 一時停止したバッチの一覧をこのセッションだけに表示するためのID
+    if "session_id" not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
     if "clear_files_flag" not in st.session_state: st.session_state.clear_files_flag = False
     if "ocr_results" not in st.session_state: st.session_state.ocr_results = None
     if "edit_mode" not in st.session_state: st.session_state.edit_mode = False
-    if "edited_cards" not in st.session_state: st.session_state.edited_cards = []
+    if "card_edits" not in st.session_state: st.session_state.card_edits = {}
+    if "edit_page" not in st.session_state: st.session_state.edit_page = 0
+    if "edit_table_rev" not in st.session_state: st.session_state.edit_table_rev = 0
     if "files_from_camera" not in st.session_state: st.session_state.files_from_camera = []
+    if "ocr_job" not in st.session_state: _restore_ocr_job(st.query_params.get("job"))
+    if "ocr_seen" not in st.session_state: st.session_state.ocr_seen = 0
+    if "db_cursors" not in st.session_state: st.session_state.db_cursors = [None]
+    if "db_view" not in st.session_state: st.session_state.db_view = None
+
+def _clear_camera_files():
+    # 撮影画像の一時ファイルも削除する
+    for f in st.session_state.get("files_from_camera", []):
+        f.remove()
+    st.session_state.files_from_camera = []
 
 def should_clear_files():
     # ファイルクリアフラグをセット
     st.session_state["clear_files_flag"] = True
     # カメラで撮影した写真もクリア
-    if "files_from_camera" in st.session_state:
-        st.session_state.files_from_camera = []
+    _clear_camera_files()
     # 再実行
     st.rerun()
 
@@ -41,9 +64,12 @@ def render_upload_tabs():
         camera_img = st.camera_input("カメラで名刺を撮影", key="camera_image")
         
         # カメラで撮影した画像がある場合、それをfilesとして扱う
+        # セッションにはバイト列を持たず、ディスクに書き出した一時ファイルだけを溜める
+        # (同じ撮影画像を、クリア後や解析開始後の再描画で再び登録しないよう、最後に登録した画像のIDを覚えておく)
         if camera_img is not None:
-            if camera_img not in st.session_state.files_from_camera:
-                st.session_state.files_from_camera.append(camera_img)
+            if camera_img.file_id != st.session_state.get("camera_last_id"):
+                st.session_state.files_from_camera.append(spool.spill(camera_img))
+                st.session_state.camera_last_id = camera_img.file_id
             
             # 撮影した画像の一覧を表示
             if len(st.session_state.files_from_camera) > 0:
@@ -51,11 +77,176 @@ def render_upload_tabs():
                 
                 # 画像をクリアするボタン
                 if st.button("撮影画像をクリア"):
-                    st.session_state.files_from_camera = []
+                    _clear_camera_files()
                     st.rerun()
     
     return files
 
+def _restore_ocr_job(job_id):
+    # 再読み込みされても、URLのジョブIDから解析結果 (と解析中なら進捗) を引き継ぐ
+    st.session_state.ocr_job = None
+    status = jobs.job_status(job_id) if job_id else None
+    if status is None:
+        return
+    st.session_state.ocr_results = jobs.job_results(job_id)
+    st.session_state.edit_mode = True
+    st.session_state.card_edits = {}
+    if status["queued"] or status["running"]:
+        st.session_state.ocr_job = job_id
+
+def start_ocr(files):
+    # OCRはワーカープロセスが行う。ここではジョブを登録するだけで、結果は render_ocr_progress が読み込む
+    files = list(files)
+    job_id = jobs.enqueue(files)
+    st.query_params["job"] = job_id
+    # 撮影画像はキューのDBにコピーしたので、一時ファイルはここで削除する
+    _clear_camera_files()
+
+    st.session_state.ocr_job = job_id
+    st.session_state.ocr_seen = 0
+    st.session_state.ocr_results = [None] * len(files)
+    st.session_state.edit_mode = True
+    st.session_state.card_edits = {}
+    st.session_state.edit_page = 0
+
+@st.fragment(run_every=1.0)
+def render_ocr_progress():
+    job_id = st.session_state.ocr_job
+    if job_id is None:
+        return
+    status = jobs.job_status(job_id)
+    if status is None:
+        st.session_state.ocr_job = None
+        return
+    total = status["total"]
+    finished = status["done"] + status["failed"]
+    if finished == 0 and status["running"] == 0:
+        st.progress(0.0, text="⏳ 解析待ち (他のジョブの処理中、またはワーカー未起動)")
+    else:
+        st.progress(finished / total, text=f"📝 OCR処理中... {finished} / {total} 枚")
+
+    # 新しい結果が届いたらページ全体を再描画して編集フォームに反映する
+    if finished != st.session_state.ocr_seen:
+        st.session_state.ocr_results = jobs.job_results(job_id)
+        st.session_state.ocr_seen = finished
+        if finished == total:
+            st.session_state.ocr_job = None
+        st.rerun()
+
+# 編集フォームの項目 (フィールド → 表示名)。左右2列に分けて表示する
+EDIT_FIELDS = {
+    "name": "名前", "company": "会社名", "email": "メールアドレス", "phone": "電話番号",
+    "department": "部署名", "job_title": "役職",
+    "qualification": "資格・肩書き", "company_address": "会社住所", "company_url": "会社URL",
+    "company_phone": "会社電話", "company_fax": "会社FAX",
+}
+EDIT_PAGE_SIZES = [10, 20, 50]
+
+# 編集内容は OCR結果 (ocr_results) との差分だけを card_edits {カード番号: {フィールド: 値}} に持つ
+# 表示するのは現在のページのカードだけなので、再描画のコストはバッチの枚数ではなくページの大きさで決まる
+
+def _base_value(i, field):
+    card = st.session_state.ocr_results[i]
+    return card.get(field) if card is not None else None
+
+def _current_card(i) -> Card:
+    card = {field: _base_value(i, field) for field in EDIT_FIELDS}
+    card.update(st.session_state.card_edits.get(i, {}))
+    return card
+
+def _set_field(i, field, value):
+    value = value or None
+    edits = st.session_state.card_edits.setdefault(i, {})
+    if value == _base_value(i, field):
+        edits.pop(field, None)
+    else:
+        edits[field] = value
+    if not edits:
+        del st.session_state.card_edits[i]
+
+def _on_field_change(i, field):
+    _set_field(i, field, st.session_state[f"edit_{i}_{field}"])
+
+def _on_table_change():
+    # 表で変更されたセル ({行番号: {列: 値}}) を差分に反映する。行番号はカード番号と同じ
+    # 解析中のカードの行に入力した値も差分として残し、解析結果が届いた後はその値を優先する
+    changes = st.session_state[f"edit_table_{st.session_state.edit_table_rev}"]["edited_rows"]
+    for i, row in changes.items():
+        for field, value in row.items():
+            if field in EDIT_FIELDS:
+                _set_field(i, field, value)
+
+def _on_edit_view_change():
+    # 表を開き直すたびに、フォームでの編集を反映した新しい表として作り直す
+    st.session_state.edit_table_rev += 1
+
+def _edit_page(delta):
+    st.session_state.edit_page += delta
+
+def _render_similar_warning(card):
+    similar = card.get("similar_to")
+    if not similar:
+        return
+    source = f"同じバッチの {similar.get('name')}" if similar["source"] == "batch" else "以前に解析した画像"
+    if similar.get("reused"):
+        # APIに送らず、ほぼ同じ画像の解析結果を再利用したカード (別人の名刺でないか確認してもらう)
+        st.warning(f"{source} とほぼ同じ画像のため、その解析結果を再利用しました (差異 {similar['distance']})。"
+                   "別の名刺の場合は内容を修正してください。")
+    else:
+        st.info(f"{source} とほぼ同じ画像です (差異 {similar['distance']})。同じ名刺を二重に登録していないか確認してください。")
+
+def _render_edit_page():
+    results = st.session_state.ocr_results
+    cols = st.columns([1, 1, 1])
+    with cols[0]:
+        page_size = st.selectbox("1ページの枚数", EDIT_PAGE_SIZES, key="edit_page_size")
+    pages = max(1, -(-len(results) // page_size))
+    page = st.session_state.edit_page = min(st.session_state.edit_page, pages - 1)
+    with cols[1]:
+        st.button("◀ 前へ", on_click=_edit_page, args=(-1,), disabled=page == 0, key="edit_prev")
+    with cols[2]:
+        st.button("次へ ▶", on_click=_edit_page, args=(1,), disabled=page >= pages - 1, key="edit_next")
+    start = page * page_size
+    st.caption(f"カード {start + 1}〜{min(start + page_size, len(results))} / 全 {len(results)} 枚")
+
+    first_ready = next((i for i in range(start, min(start + page_size, len(results))) if results[i] is not None), None)
+    left = list(EDIT_FIELDS)[:6]
+    for i in range(start, min(start + page_size, len(results))):
+        if results[i] is None:
+            st.caption(f"カード {i+1}: 解析中...")
+            continue
+        card = _current_card(i)
+        with st.expander(f"カード {i+1}: {card.get('name') or '名前なし'} - {card.get('company') or '会社名なし'}",
+                         expanded=(i == first_ready)):
+            _render_similar_warning(results[i])
+            cols = st.columns([1, 1])
+            for field, label in EDIT_FIELDS.items():
+                with cols[0 if field in left else 1]:
+                    st.text_input(label, card[field] or "", key=f"edit_{i}_{field}",
+                                  on_change=_on_field_change, args=(i, field))
+
+def _render_edit_table():
+    # 全カードを1つの表で編集する (行番号 = カード番号。解析中のカードは空の行として表示する)
+    results = st.session_state.ocr_results
+    rows = []
+    for i, card in enumerate(results):
+        if card is None:
+            rows.append({"状態": "解析中", **_current_card(i)})
+        else:
+            similar = card.get("similar_to") or {}
+            status = "⚠ 画像を再利用" if similar.get("reused") else "類似画像あり" if similar else ""
+            rows.append({"状態": status, **_current_card(i)})
+    st.data_editor(
+        pd.DataFrame(rows, columns=["状態"] + list(EDIT_FIELDS)),
+        column_config={"状態": st.column_config.TextColumn("状態", disabled=True),
+                       **{field: st.column_config.TextColumn(label) for field, label in EDIT_FIELDS.items()}},
+        hide_index=True,
+        num_rows="fixed",
+        use_container_width=True,
+        key=f"edit_table_{st.session_state.edit_table_rev}",
+        on_change=_on_table_change,
+    )
+
 def render_edit_form():
     if not st.session_state.edit_mode or not st.session_state.ocr_results:
         return
@@ -63,140 +254,156 @@ def render_edit_form():
     st.subheader("📝 OCR結果の編集")
     st.write("データを確認し、必要に応じて編集してください。")
     
-    edited_cards = []
-    
-    # 各カードの編集フォームを表示
-    for i, card in enumerate(st.session_state.edited_cards):
-        with st.expander(f"カード {i+1}: {card.get('name', '名前なし')} - {card.get('company', '会社名なし')}", expanded=(i==0)):
-            cols = st.columns([1, 1])
-            
-            # 左側のカラム
-            with cols[0]:
-                name = st.text_input("名前", card.get("name", ""), key=f"name_{i}")
-                company = st.text_input("会社名", card.get("company", ""), key=f"company_{i}")
-                email = st.text_input("メールアドレス", card.get("email", ""), key=f"email_{i}")
-                phone = st.text_input("電話番号", card.get("phone", ""), key=f"phone_{i}")
-                department = st.text_input("部署名", card.get("department", ""), key=f"department_{i}")
-                job_title = st.text_input("役職", card.get("job_title", ""), key=f"job_title_{i}")
-            
-            # 右側のカラム
-            with cols[1]:
-                qualification = st.text_input("資格・肩書き", card.get("qualification", ""), key=f"qualification_{i}")
-                company_address = st.text_input("会社住所", card.get("company_address", ""), key=f"company_address_{i}")
-                company_url = st.text_input("会社URL", card.get("company_url", ""), key=f"company_url_{i}")
-                company_phone = st.text_input("会社電話", card.get("company_phone", ""), key=f"company_phone_{i}")
-                company_fax = st.text_input("会社FAX", card.get("company_fax", ""), key=f"company_fax_{i}")
-            
-            # 編集後のカードを保存
-            edited_card = {
-                "name": name or None,
-                "company": company or None,
-                "email": email or None,
-                "phone": phone or None,
-                "department": department or None,
-                "job_title": job_title or None,
-                "qualification": qualification or None,
-                "company_address": company_address or None,
-                "company_url": company_url or None,
-                "company_phone": company_phone or None,
-                "company_fax": company_fax or None
-            }
-            edited_cards.append(edited_card)
+    view = st.radio("編集方法", ["カードごと", "表でまとめて"], horizontal=True, key="edit_view",
+                    on_change=_on_edit_view_change)
+    if view == "カードごと":
+        _render_edit_page()
+    else:
+        _render_edit_table()
+    if st.session_state.card_edits:
+        st.caption(f"編集済み: {len(st.session_state.card_edits)} 枚")
     
     # 編集完了ボタン
-    if st.button("編集完了、保存へ進む"):
-        # 編集後のデータをセッションに保存
-        st.session_state.edited_cards = edited_cards
-        
-        # 初期状態を定義
-        initial_state = {"cards": edited_cards}
+    if st.button("編集完了、保存へ進む", disabled=st.session_state.ocr_job is not None):
+        # OCR結果に編集内容を重ねたカード (解析中のカードは含めない)
+        edited_cards = [_current_card(i) for i, card in enumerate(st.session_state.ocr_results) if card is not None]
         
-        # チェックノードを実行して重複カードを検出
-        state = check_dup(initial_state.copy())
+        # グラフを実行し、重複があれば gate で一時停止する (それまでの結果はチェックポイントに保存される)
+        batch_id, state, paused = start_batch(get_graph(), edited_cards, st.session_state.session_id)
+        # 解析結果はグラフのチェックポイント (または保存済みのDB) に移ったので、ジョブは引き継がない
+        if "job" in st.query_params:
+            del st.query_params["job"]
         
         # 編集モードを無効化
         st.session_state.edit_mode = False
+        st.session_state.card_edits = {}
         
-        if state["need_human"]:
-            # 重複がある場合はセッションに保存
-            st.session_state.current_state = state
-            st.session_state.dup_cards = state["dup_cards"]
-            st.rerun()  # 重複解決モードに切り替え
+        if paused:
+            # 重複がある場合はバッチIDを記録し、重複解決モードに切り替え
+            st.session_state.batch_id = batch_id
+            st.query_params["batch"] = batch_id
+            st.rerun()
         else:
-            # 重複がない場合は直接セーブ処理を行う
-            # decisionsが不要なのでapply_decisionをスキップ
-            state["final_cards"] = state["new_cards"]
-            state = save_node(state)
-            st.success("保存完了！")
+            # 重複がない場合は保存まで完了している
+            st.success(f"保存完了！新規 {state['saved']['inserted']} 件 / 更新 {state['saved']['updated']} 件")
             
             # 保存後にファイルをクリア
             should_clear_files()
             st.rerun()  # 編集モードを完全に無効化
 
+def _clear_batch():
+    st.session_state.batch_id = None
+    if "batch" in st.query_params:
+        del st.query_params["batch"]
+
 def render_duplicate_resolution():
-    if not st.session_state.dup_cards:
+    graph = get_graph()
+    if not st.session_state.batch_id:
+        # このセッションで中断したバッチ (別のバッチを始めた場合など) があれば、選んで再開できる
+        # セッション切れ・再起動の後は、URLのバッチIDから再開する
+        pending = paused_batches(graph, st.session_state.session_id)
+        if pending:
+            cols = st.columns([3, 1])
+            with cols[0]:
+                batch_id = st.selectbox("重複確認待ちのバッチ", pending, format_func=lambda b: b[:8])
+            with cols[1]:
+                if st.button("再開"):
+                    st.session_state.batch_id = batch_id
+                    st.query_params["batch"] = batch_id
+                    st.rerun()
+        return
+    
+    # チェックポイントからステートを読み込む (OCR・重複チェックはやり直さない)
+    state = get_batch(graph, st.session_state.batch_id)
+    if state is None:
+        _clear_batch()
         return
     
     st.subheader("重複カードの処理")
     decisions = {}
-    for c in st.session_state.dup_cards:
-        email = c["email"]
+    for c in state["dup_cards"]:
+        key = dup_key(c)
+        label = f"{c.get('email') or 'メールアドレスなし'} ({c.get('name')} / {c.get('company')})"
+        match = c.get("duplicate_of")
+        if match:
+            # あいまい一致の場合は、一致した既存連絡先と根拠を表示する
+            label += (f" → 既存: {match['name']} / {match['company']} / {match['email']}"
+                      f" ({match['reason']}, 類似度 {match['score']:.2f})")
         choice = st.radio(
-            f"{email} ({c.get('name')} / {c.get('company')})",
+            label,
             ("overwrite", "skip"),
-            key=email,
+            key=key,
         )
-        decisions[email] = choice
+        decisions[key] = choice
     
     if st.button("決定して保存"):
-        # 保存していた状態にユーザーの決定を追加
-        if st.session_state.current_state:
-            # 最新のステートにdecisionsを追加
-            updated_state = st.session_state.current_state.copy()
-            updated_state["decisions"] = decisions
-            
-            # グラフの実行を継続
-            # applyノードから手動で実行
-            result = apply_decision(updated_state)
-            result = save_node(result)
-            
-            st.success(f"保存完了！スキップ: {', '.join(result.get('skipped', [])) or 'なし'}")
-            st.session_state.dup_cards = None
-            st.session_state.current_state = None
-            st.json(result["final_cards"])
-            
-            # ファイルをクリア
-            should_clear_files()
+        # ユーザーの決定を渡してグラフを再開 (apply → save)
+        result = resume_batch(graph, st.session_state.batch_id, decisions)
+        
+        st.success(f"保存完了！新規 {result['saved']['inserted']} 件 / 更新 {result['saved']['updated']} 件 / "
+                   f"スキップ {len(result.get('skipped', []))} 件")
+        _clear_batch()
+        st.json(result["final_cards"] + result.get("final_updates", []))
+        
+        # ファイルをクリア
+        should_clear_files()
+
+# 一覧の並び順 (db.list_contacts の order_by → 表示名)
+ORDER_LABELS = {"id": "登録順", "name": "氏名", "company": "会社名", "email": "メールアドレス"}
+
+def _next_page(after_id):
+    st.session_state.db_cursors.append(after_id)
+
+def _prev_page():
+    if len(st.session_state.db_cursors) > 1:
+        st.session_state.db_cursors.pop()
 
 def render_contact_database():
-    rows = get_all_contacts()
+    # 件数・一覧はDB側でページ単位に取得し、結果はdb側でキャッシュされる (保存時に破棄)
+    total = count_contacts()
     
-    if not rows:
+    if not total:
         return
     
     st.divider()
     st.subheader("📚 名刺データベース")
     
-    # データをPandasデータフレームに変換して列名を指定
-    df = pd.DataFrame(rows, columns=[
-        "氏名", "会社名", "メールアドレス", "個人電話", 
-        "部署名", "役職", "肩書き", "会社住所", 
-        "会社URL", "会社電話", "会社FAX"
-    ])
-    
     # 検索機能のためのフィルターボックス
     st.text_input("🔍 検索", key="search_term", placeholder="検索語句を入力...")
-    search_term = st.session_state.get("search_term", "").lower()
+    search_term = st.session_state.get("search_term", "").strip()
     
-    # 検索条件に一致する行をフィルタリング
+    cols = st.columns([1, 1])
+    with cols[0]:
+        order_by = st.selectbox("並び順", list(ORDER_LABELS), format_func=ORDER_LABELS.get, key="db_order_by",
+                                disabled=bool(search_term))
+    with cols[1]:
+        page_size = st.selectbox("表示件数", [50, 100, 500], key="db_page_size")
+    
+    # 検索語句・並び順・表示件数が変わったら先頭ページに戻す
+    view = (search_term, order_by, page_size)
+    if st.session_state.db_view != view:
+        st.session_state.db_view = view
+        st.session_state.db_cursors = [None]
+    page = len(st.session_state.db_cursors) - 1
+    
+    # 検索条件に一致する行はDBの全文検索インデックスで絞り込む
     if search_term:
-        mask = False
-        for col in df.columns:
-            # 各列で検索語句を含む行を探す (NaN値は文字列に変換)
-            mask = mask | df[col].astype(str).str.lower().str.contains(search_term, na=False)
-        filtered_df = df[mask]
+        rows = search_contacts(search_term, limit=page_size, offset=page * page_size)
+        matched = count_contacts(search_term)
+        last_id = None
     else:
-        filtered_df = df
+        # キーセットページング: 前ページ最後の id から続きを取得する
+        page_rows = list_contacts(st.session_state.db_cursors[-1], page_size, order_by)
+        rows = [r[1:] for r in page_rows]
+        last_id = page_rows[-1][0] if page_rows else None
+        matched = total
+    
+    # データをPandasデータフレームに変換して列名を指定
+    filtered_df = pd.DataFrame(rows, columns=[
+        "氏名", "会社名", "メールアドレス", "個人電話", 
+        "部署名", "役職", "肩書き", "会社住所", 
+        "会社URL", "会社電話", "会社FAX"
+    ])
     
     # カスタム CSS で横スクロールを有効化し、最小幅を設定
     st.markdown("""
@@ -231,5 +438,31 @@ def render_contact_database():
         )
         st.markdown('</div>', unsafe_allow_html=True)
     
+    # ページ送り
+    start = page * page_size
+    has_next = start + len(filtered_df) < matched
+    nav = st.columns([1, 1, 4])
+    with nav[0]:
+        st.button("◀ 前へ", on_click=_prev_page, disabled=page == 0, key="db_prev")
+    with nav[1]:
+        st.button("次へ ▶", on_click=_next_page, args=(last_id,), disabled=not has_next, key="db_next")
+    
     # 統計情報
-    st.caption(f"全 {len(df)} 件中 {len(filtered_df)} 件表示中")
+    shown = f"{start + 1}〜{start + len(filtered_df)}" if len(filtered_df) else "0"
+    if search_term:
+        st.caption(f"全 {total} 件中 {matched} 件が一致 ({shown} 件目を表示中)")
+    else:
+        st.caption(f"全 {total} 件中 {shown} 件目を表示中")
+
+def render_stats_panel():
+    # ステージごとの所要時間・トークン数・キャッシュ効果 (このプロセスでの累計)
+    snapshot = metrics.snapshot()
+    if not snapshot:
+        return
+    with st.expander("📊 処理統計"):
+        st.dataframe(pd.DataFrame.from_dict(snapshot, orient="index").fillna(0), use_container_width=True)
+        cache_stats, image_stats = cache.stats(), preprocess.stats()
+        peak_rss = metrics.peak_rss_mb()
+        st.caption(f"OCRキャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}　"
+                   f"画像: {image_stats['bytes_before']:,} → {image_stats['bytes_after']:,} bytes"
+                   + (f"　最大メモリ使用量: {peak_rss:,.0f} MB" if peak_rss is not None else ""))